@@ -1,50 +1,47 @@
 import streamlit as st
 import sqlite3
-from passlib.hash import pbkdf2_sha256
-import re
-import os
-
-# 初始化数据库
-def init_db():
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (username TEXT PRIMARY KEY, 
-                  nickname TEXT NOT NULL,
-                  phone TEXT UNIQUE NOT NULL,
-                  password TEXT NOT NULL,
-                  role TEXT NOT NULL,
-                  avatar_path TEXT NOT NULL DEFAULT 'default_avatar.png')''')  # 确保包含这个字段
-    conn.commit()
-    conn.close()
-
-
-# 验证用户登录
+import requests
+import db
+import auth
+import profile_cache
+import avatars
+from config import SERVER_URL
+
+AUTH_TIMEOUT = 10
+
+
+# 验证用户登录：由 server.py 在进程池中校验密码，成功时返回会话令牌，失败返回None
 def verify_user(username, password):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT password FROM users WHERE username=?", (username,))
-    result = c.fetchone()
-    conn.close()
-    if result and pbkdf2_sha256.verify(password, result[0]):
-        return True
-    return False
+    try:
+        response = requests.post(f"{SERVER_URL}/auth/login",
+                                 json={"username": username, "password": password}, timeout=AUTH_TIMEOUT)
+    except requests.exceptions.RequestException:
+        # 服务端不可用时在本进程校验
+        ok, new_hash = auth.verify_password(password, db.get_password_hash(username))
+        if new_hash is not None:
+            db.update_password_hash(username, new_hash)
+        return auth.issue_token(username) if ok else None
+    if response.status_code != 200:
+        return None
+    return response.json()["token"]
 
 
 # 注册新用户
 def register_user(username, nickname, phone, password, role, avatar_path='default_avatar.png'):
+    form = {"username": username, "nickname": nickname, "phone": phone,
+            "password": password, "role": role, "avatar_path": avatar_path}
+    try:
+        response = requests.post(f"{SERVER_URL}/auth/register", json=form, timeout=AUTH_TIMEOUT)
+        return response.json().get("status", "error")
+    except requests.exceptions.RequestException:
+        pass
+    # 服务端不可用时在本进程注册
     try:
         # 验证手机号格式
-        if not re.match(r'^1[3-9]\d{9}$', phone):
+        if not auth.PHONE_RE.match(phone):
             return "invalid_phone"
 
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        hashed = pbkdf2_sha256.hash(password)
-        c.execute("INSERT INTO users VALUES (?, ?, ?, ?, ?, ?)",
-                  (username, nickname, phone, hashed, role, avatar_path))
-        conn.commit()
-        conn.close()
+        db.create_user(username, nickname, phone, auth.hash_password(password), role, avatar_path)
         return "success"
     except sqlite3.IntegrityError as e:
         if "users.username" in str(e):
@@ -71,8 +68,7 @@ hide_sidebar_css = """
 """
 st.markdown(hide_sidebar_css, unsafe_allow_html=True)
 
-# 初始化数据库和会话状态
-init_db()
+# 初始化会话状态（数据库迁移在 db 模块首次使用时执行）
 if 'authenticated' not in st.session_state:
     st.session_state.authenticated = False
 
@@ -89,9 +85,11 @@ with tab1:
         login_submitted = st.form_submit_button("登录")
 
         if login_submitted:
-            if verify_user(login_user, login_pass):
+            token = verify_user(login_user, login_pass)
+            if token:
                 st.session_state.authenticated = True
                 st.session_state.username = login_user
+                st.session_state.session_token = token
                 st.success("登录成功！")
                 st.switch_page("pages/single_chat.py")
             else:
@@ -113,12 +111,12 @@ with tab2:
             error_messages = []
             avatar_path = 'default_avatar.png'
             if reg_avatar is not None:
-                # 修正路径写法（去掉开头的斜杠）
-                avatar_path = f"avatars/{reg_user}_avatar.{reg_avatar.type.split('/')[-1]}"  # ← 主要修改这里
-                os.makedirs("avatars", exist_ok=True)
-                with open(avatar_path, "wb") as f:
-                    f.write(reg_avatar.getbuffer())
-                st.success("头像上传成功！")
+                # 缩放为 WebP 缩略图，按内容哈希保存
+                try:
+                    avatar_path = avatars.save_avatar(reg_avatar.getvalue())
+                    st.success("头像上传成功！")
+                except ValueError as e:
+                    error_messages.append(f"头像处理失败：{e}")
             if len(reg_user) < 4:
                 error_messages.append("用户名至少需要4个字符")
             if len(reg_nickname) < 2:  # 新增昵称验证
@@ -135,6 +133,8 @@ with tab2:
                 # 修正参数，添加nickname
                 result = register_user(reg_user, reg_nickname, reg_phone, reg_pass, reg_role, avatar_path)
                 if result == "success":
+                    # 注册前可能缓存过该用户名不存在的查询结果
+                    profile_cache.invalidate_user(reg_user)
                     st.success("注册成功！请登录")
                 elif result == "username_exists":
                     st.error("用户名已存在")
@@ -0,0 +1,66 @@
+import argparse
+import asyncio
+import os
+import db
+
+# 冷数据归档：最后一条消息早于 ARCHIVE_AFTER_DAYS 天的单人对话，消息压缩后移出热表，打开对话时自动恢复；
+# 恢复后 ARCHIVE_AFTER_DAYS 天内不会再被归档，归档期间消息仍可全文检索
+# 群聊消息不归档：群聊页面按ID游标增量同步，需要完整的热表
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "90"))
+# server.py 中两次归档之间的间隔（秒）；ARCHIVE_AFTER_DAYS 为 0 时不运行
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL_SECONDS", "3600"))
+ARCHIVE_BATCH_SIZE = 100
+
+
+# 归档全部不活跃的对话，每个对话单独一个事务，不会长时间持有写锁；返回 (对话数, 消息数)
+def archive_inactive(days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    conversations = messages = 0
+    while True:
+        conversation_ids = db.list_inactive_conversations(days, batch_size)
+        if not conversation_ids:
+            return conversations, messages
+        for conversation_id in conversation_ids:
+            archived = db.archive_conversation(conversation_id)
+            if archived:
+                conversations += 1
+                messages += archived
+
+
+# server.py 中的周期性归档任务
+class Archiver:
+    def __init__(self, days=ARCHIVE_AFTER_DAYS, interval=ARCHIVE_INTERVAL):
+        self.days = days
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        if self.days > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                conversations, messages = await asyncio.to_thread(archive_inactive, self.days)
+                if conversations:
+                    print(f"已归档 {conversations} 个对话，共 {messages} 条消息")
+            except Exception as e:
+                print(f"对话归档失败: {e}")
+            await asyncio.sleep(self.interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="归档长期不活跃的单人对话")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS, help="最后一条消息距今的天数")
+    args = parser.parse_args()
+    conversations, messages = archive_inactive(args.days)
+    print(f"已归档 {conversations} 个对话，共 {messages} 条消息")
@@ -0,0 +1,79 @@
+import os
+import re
+import secrets
+from passlib.hash import pbkdf2_sha256
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+# 密码哈希策略：修改轮数后，用户下次登录时按新轮数重新哈希
+PASSWORD_HASH_ROUNDS = int(os.environ.get("PASSWORD_HASH_ROUNDS", str(pbkdf2_sha256.default_rounds)))
+# server.py 中执行哈希的进程池大小
+AUTH_HASH_WORKERS = int(os.environ.get("AUTH_HASH_WORKERS", str(os.cpu_count() or 2)))
+# 会话令牌有效期（秒）
+SESSION_TTL = int(os.environ.get("SESSION_TTL", str(7 * 24 * 3600)))
+# 令牌签名密钥：未配置 SESSION_SECRET 时首次使用生成并保存到文件，多个 worker 和页面进程共用
+SESSION_SECRET = os.environ.get("SESSION_SECRET")
+SESSION_SECRET_FILE = os.environ.get("SESSION_SECRET_FILE", ".session_secret")
+
+PHONE_RE = re.compile(r'^1[3-9]\d{9}$')
+
+_hasher = pbkdf2_sha256.using(rounds=PASSWORD_HASH_ROUNDS)
+_serializer = None
+
+
+# 以下两个函数会在进程池中执行，只依赖 passlib
+def hash_password(password):
+    return _hasher.hash(password)
+
+
+# 返回 (是否正确, 新哈希)；哈希轮数与当前策略不同时返回新哈希，由调用方写回数据库
+def verify_password(password, password_hash):
+    try:
+        if not password_hash or not pbkdf2_sha256.verify(password, password_hash):
+            return False, None
+    except ValueError:
+        # 数据库中的哈希格式无法识别
+        return False, None
+    if pbkdf2_sha256.from_string(password_hash).rounds != PASSWORD_HASH_ROUNDS:
+        return True, hash_password(password)
+    return True, None
+
+
+def _load_secret():
+    if SESSION_SECRET:
+        return SESSION_SECRET
+    if not os.path.exists(SESSION_SECRET_FILE):
+        # 先写临时文件再硬链接到目标路径，多个进程同时生成时只有一个生效
+        tmp_path = f"{SESSION_SECRET_FILE}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(secrets.token_hex(32))
+        os.chmod(tmp_path, 0o600)
+        try:
+            os.link(tmp_path, SESSION_SECRET_FILE)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp_path)
+    with open(SESSION_SECRET_FILE) as f:
+        return f.read().strip()
+
+
+def _get_serializer():
+    global _serializer
+    if _serializer is None:
+        _serializer = URLSafeTimedSerializer(_load_secret(), salt="math-llm-session")
+    return _serializer
+
+
+# 签发会话令牌：页面凭令牌确认登录状态，不必再查数据库
+def issue_token(username):
+    return _get_serializer().dumps(username)
+
+
+# 令牌有效时返回用户名，否则返回None（签名错误或已过期）
+def verify_token(token):
+    if not token:
+        return None
+    try:
+        return _get_serializer().loads(token, max_age=SESSION_TTL)
+    except BadSignature:
+        return None
@@ -0,0 +1,66 @@
+import hashlib
+import io
+import os
+import re
+from PIL import Image, ImageOps, UnidentifiedImageError
+from config import SERVER_URL
+
+# 头像统一缩放为固定尺寸的 WebP 缩略图，按内容哈希命名：同一文件内容不变，可以被浏览器长期缓存
+AVATAR_DIR = os.environ.get("AVATAR_DIR", "avatars")
+AVATAR_SIZE = 128
+AVATAR_QUALITY = 85
+# 浏览器访问头像的服务地址（server.py 与页面不在同一台机器时需要配置）
+AVATAR_BASE_URL = os.environ.get("AVATAR_BASE_URL", SERVER_URL)
+# 上传图片的像素上限，防止解压炸弹
+MAX_UPLOAD_PIXELS = 40_000_000
+
+AVATAR_NAME_RE = re.compile(r"^[0-9a-f]{64}\.webp$")
+DEFAULT_AVATAR_COLOR = "#E6E6FA"
+
+_default_avatar = None
+
+
+def _store(image):
+    buffer = io.BytesIO()
+    image.save(buffer, "WEBP", quality=AVATAR_QUALITY, method=6)
+    data = buffer.getvalue()
+    name = f"{hashlib.sha256(data).hexdigest()}.webp"
+    path = os.path.join(AVATAR_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(AVATAR_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return f"{AVATAR_DIR}/{name}"
+
+
+# 处理上传的头像，返回保存到 users.avatar_path 的相对路径；不是有效图片时抛出 ValueError
+def save_avatar(data):
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.width * image.height > MAX_UPLOAD_PIXELS:
+            raise ValueError("图片尺寸过大")
+        # JPEG 可以在解码时直接缩小，避免解码整张大图
+        image.draft("RGB", (AVATAR_SIZE * 2, AVATAR_SIZE * 2))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise ValueError("无法识别的图片") from e
+    return _store(ImageOps.fit(image, (AVATAR_SIZE, AVATAR_SIZE), Image.LANCZOS))
+
+
+def avatar_name(avatar_path):
+    name = os.path.basename(avatar_path or "")
+    return name if AVATAR_NAME_RE.match(name) else None
+
+
+# 页面 <img src> 使用的地址；旧数据（原图路径或默认头像）统一显示生成的默认头像
+def avatar_url(avatar_path):
+    global _default_avatar
+    name = avatar_name(avatar_path)
+    if name is None or not os.path.exists(os.path.join(AVATAR_DIR, name)):
+        if _default_avatar is None:
+            _default_avatar = avatar_name(_store(Image.new("RGB", (AVATAR_SIZE, AVATAR_SIZE), DEFAULT_AVATAR_COLOR)))
+        name = _default_avatar
+    return f"{AVATAR_BASE_URL}/avatars/{name}"
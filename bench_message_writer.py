@@ -0,0 +1,79 @@
+import argparse
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+
+# 群聊消息写入基准：对比原先每条消息 connect/insert/commit 与后台批量写入的吞吐量
+# 用法：python bench_message_writer.py --messages 2000 --clients 50
+
+
+# 原先的写法：默认回滚日志模式，每条消息新建连接并单独提交
+def bench_per_message(path, n):
+    # 只用到 register_functions（迁移与触发器需要 fts_tokens），不经过 db 的连接池
+    import db
+    import migrations
+
+    with sqlite3.connect(path, isolation_level=None) as conn:
+        db.register_functions(conn)
+        migrations.migrate(conn)
+    conn.close()
+    start = time.perf_counter()
+    for i in range(n):
+        with sqlite3.connect(path) as conn:
+            db.register_functions(conn)
+            conn.execute("INSERT INTO group_messages (group_id, user_id, content, msg_id) VALUES (?, ?, ?, ?)",
+                         (1, "bench", f"消息 {i}", f"sync-{i}"))
+            conn.commit()
+        conn.close()
+    return n / (time.perf_counter() - start)
+
+
+async def bench_writer(n, clients, wait_commit):
+    from message_writer import GroupMessageWriter
+
+    writer = GroupMessageWriter()
+    writer.start()
+
+    # 模拟多个 WebSocket 连接并发发送；wait_commit 对应 ack after commit，否则为 ack after enqueue
+    async def client(c):
+        pending = []
+        for i in range(c, n, clients):
+            committed = writer.enqueue(1, "bench", f"消息 {i}", f"batch-{i}")
+            if wait_commit:
+                await committed
+            else:
+                pending.append(committed)
+                await asyncio.sleep(0)
+        await asyncio.gather(*pending)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(c) for c in range(clients)))
+    elapsed = time.perf_counter() - start
+    await asyncio.to_thread(writer.stop)
+    return n / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="群聊消息写入吞吐量基准")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # db 在导入时读取 USERS_DB，必须在任何 import db 之前设置，否则基准会写入工作目录下的 users.db
+        os.environ["USERS_DB"] = os.path.join(tmp, "after.db")
+        import db
+
+        before = bench_per_message(os.path.join(tmp, "before.db"), args.messages)
+
+        after_commit = asyncio.run(bench_writer(args.messages, args.clients, True))
+        after_enqueue = asyncio.run(bench_writer(args.messages, args.clients, False))
+        with db.connection() as conn:
+            total = conn.execute("SELECT COUNT(*) FROM group_messages").fetchone()[0]
+
+    print(f"逐条提交:                  {before:10.0f} 条/秒")
+    print(f"批量写入 (ack after commit):  {after_commit:10.0f} 条/秒  (x{after_commit / before:.1f})")
+    print(f"批量写入 (ack after enqueue): {after_enqueue:10.0f} 条/秒  (x{after_enqueue / before:.1f})")
+    print(f"批量写入总数: {total}")
@@ -0,0 +1,6 @@
+import os
+
+# 页面访问 server.py 的地址；server.py 与页面不在同一台机器时需要配置
+SERVER_URL = os.environ.get("MATH_SERVER_URL", "http://127.0.0.1:6006")
+# 群聊机器人发言使用的用户ID；该用户名保留，不能注册
+BOT_USER_ID = "assistant"
@@ -0,0 +1,173 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 对话上下文的 token 预算：最近的若干轮原样保留，更早的轮次折叠为滚动摘要
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "2000"))
+# 预算中留给摘要的部分
+SUMMARY_TOKEN_BUDGET = int(os.environ.get("CONTEXT_SUMMARY_TOKENS", "400"))
+TIKTOKEN_ENCODING = os.environ.get("TIKTOKEN_ENCODING", "cl100k_base")
+# 缓存摘要的对话/群聊数
+SUMMARY_CACHE_SIZE = int(os.environ.get("CONTEXT_SUMMARY_CACHE_SIZE", "1024"))
+# 每条消息的角色、分隔符等额外开销
+MESSAGE_OVERHEAD_TOKENS = 4
+# 摘要中每条旧消息最多保留的 token 数
+SUMMARY_TURN_TOKENS = 40
+
+ROLE_NAMES = {"user": "用户", "assistant": "助手"}
+
+_encoding = None
+_encoding_lock = threading.Lock()
+_CJK_RE = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]")
+
+
+# tiktoken 首次使用时需要下载词表，离线或未安装时退化为估算（汉字按1个token，其余按4个字符1个token）
+def get_encoding():
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                try:
+                    _encoding = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+                except Exception as e:
+                    print(f"tiktoken 不可用，按字符估算 token 数: {e}")
+                    _encoding = False
+    return _encoding or None
+
+
+def count_tokens(text):
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def truncate_tokens(text, limit):
+    encoding = get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= limit:
+            return text
+        return encoding.decode(tokens[:limit]) + "…"
+    if count_tokens(text) <= limit:
+        return text
+    # 估算模式下二分查找不超过预算的最长前缀
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(text[:mid]) <= limit:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + "…"
+
+
+def message_tokens(message):
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+# 从最新的消息往前取，返回不超过预算的最近消息的起始下标；最新一条单独超出预算时返回 len(history)
+def split_recent(history, budget):
+    used = 0
+    cut = len(history)
+    while cut > 0:
+        cost = message_tokens(history[cut - 1])
+        if used + cost > budget:
+            break
+        used += cost
+        cut -= 1
+    return cut
+
+
+# 无状态的裁剪：只保留预算内最近的消息（用于服务端收到的客户端历史）
+def fit_recent(history, budget=CONTEXT_TOKEN_BUDGET):
+    cut = split_recent(history, budget)
+    if cut == len(history) and history:
+        last = history[-1]
+        return [dict(last, content=truncate_tokens(last["content"], budget - MESSAGE_OVERHEAD_TOKENS))]
+    return history[cut:]
+
+
+# 旧消息的摘要行：角色 + 第一行内容，截断到 SUMMARY_TURN_TOKENS
+def summarize_turn(message):
+    role = ROLE_NAMES.get(message["role"], message["role"])
+    first_line = message["content"].strip().split("\n", 1)[0]
+    return f"{role}: {truncate_tokens(first_line, SUMMARY_TURN_TOKENS)}"
+
+
+def _fingerprint(message):
+    return hash((message["role"], message["content"]))
+
+
+# 按对话/群聊缓存滚动摘要：每次只把新滑出原文窗口的消息追加到摘要，超出摘要预算时丢弃最早的摘要行
+class ContextBuilder:
+    def __init__(self, budget=CONTEXT_TOKEN_BUDGET, summary_budget=SUMMARY_TOKEN_BUDGET,
+                 max_entries=SUMMARY_CACHE_SIZE):
+        self.budget = budget
+        self.summary_budget = summary_budget
+        self.max_entries = max_entries
+        # key -> {"lines": [(摘要行, token数)], "count": 已摘要的消息数, "last": 最后一条已摘要消息的指纹}
+        self._summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # history 为 [{"role", "content"}, ...]，返回预算内的上下文：摘要（如有）+ 最近的原文消息
+    def build(self, key, history):
+        verbatim_budget = self.budget - self.summary_budget
+        cut = split_recent(history, verbatim_budget)
+        if cut == len(history) and history:
+            # 最新一条单独超出预算：截断它，其余全部进入摘要
+            recent = fit_recent(history, verbatim_budget)
+            cut -= 1
+        else:
+            recent = history[cut:]
+        if cut == 0:
+            return recent
+        summary = self._summarize(key, history[:cut])
+        return [{"role": "system", "content": f"此前对话摘要：\n{summary}"}] + recent
+
+    def invalidate(self, key):
+        with self._lock:
+            self._summaries.pop(key, None)
+
+    def _summarize(self, key, older):
+        with self._lock:
+            entry = self._summaries.get(key)
+        start = self._resume_from(entry, older)
+        lines = list(entry["lines"]) if start else []
+        for message in older[start:]:
+            line = summarize_turn(message)
+            lines.append((line, count_tokens(line) + 1))
+        total = sum(tokens for _, tokens in lines)
+        while lines and total > self.summary_budget:
+            total -= lines.pop(0)[1]
+
+        with self._lock:
+            self._summaries[key] = {"lines": lines, "count": len(older), "last": _fingerprint(older[-1])}
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.max_entries:
+                self._summaries.popitem(last=False)
+        return "\n".join(line for line, _ in lines)
+
+    # 找到上次摘要到的位置：对话只会在末尾追加，先按上次的消息数核对；
+    # 群聊的历史是滑动窗口，再从后往前查找上次最后一条；都找不到时从头重建
+    @staticmethod
+    def _resume_from(entry, older):
+        if entry is None:
+            return 0
+        count = entry["count"]
+        if 0 < count <= len(older) and _fingerprint(older[count - 1]) == entry["last"]:
+            return count
+        for i in range(len(older) - 1, -1, -1):
+            if _fingerprint(older[i]) == entry["last"]:
+                return i + 1
+        return 0
+
+
+builder = ContextBuilder()
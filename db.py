@@ -0,0 +1,532 @@
+import json
+import os
+import queue
+import random
+import sqlite3
+import string
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+import zstandard
+import migrations
+import fulltext
+from config import BOT_USER_ID
+
+# 共享的数据访问层：app.py、两个页面和 server.py 都通过这里访问 users.db
+DB_PATH = os.environ.get("USERS_DB", "users.db")
+# 连接池中保留的空闲连接数
+POOL_SIZE = int(os.environ.get("USERS_DB_POOL_SIZE", "8"))
+# 每个连接缓存的预编译语句数
+CACHED_STATEMENTS = 256
+BUSY_TIMEOUT_MS = 5000
+
+# 冷数据归档时每块压缩的消息数与 zstd 压缩级别
+ARCHIVE_CHUNK_MESSAGES = 500
+ARCHIVE_ZSTD_LEVEL = int(os.environ.get("ARCHIVE_ZSTD_LEVEL", "10"))
+
+# WAL模式下读者与写者互不阻塞；NORMAL同步级别在WAL下仍能保证数据库一致性
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+)
+
+
+@dataclass(frozen=True)
+class User:
+    username: str
+    nickname: str
+    phone: str
+    role: str
+    avatar_path: str
+
+
+@dataclass(frozen=True)
+class Conversation:
+    id: int
+    user_id: str
+    title: str
+    created_at: str
+
+
+@dataclass(frozen=True)
+class Message:
+    id: int
+    conversation_id: int
+    role: str
+    content: str
+    timestamp: str
+
+
+@dataclass(frozen=True)
+class GroupChat:
+    id: int
+    title: str
+    invite_code: str
+    created_at: str
+
+
+@dataclass(frozen=True)
+class GroupMessage:
+    id: int
+    group_id: int
+    user_id: str
+    content: str
+    msg_id: Optional[str]
+    timestamp: str
+
+
+# 全文检索结果：parent_id 为对话ID或群聊ID，author 为单人对话中的角色或群聊中的用户名
+@dataclass(frozen=True)
+class SearchHit:
+    id: int
+    parent_id: int
+    author: str
+    snippet: str
+    timestamp: str
+    score: float
+
+
+# 全文检索触发器调用的分词函数：写入消息表的连接都必须注册，
+# 不经过本模块的连接（如 sqlite3 命令行）写入消息表会因缺少该函数而失败
+def register_functions(conn):
+    conn.create_function("fts_tokens", 1, fulltext.fts_tokens, deterministic=True)
+
+
+# 连接池：Streamlit 每次重跑脚本都在新线程中执行，因此连接可以跨线程借还（check_same_thread=False），
+# 同一时刻一个连接只被一个线程使用。连接使用自动提交模式，写操作通过 transaction() 显式开启事务
+class ConnectionPool:
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path,
+                               timeout=BUSY_TIMEOUT_MS / 1000,
+                               isolation_level=None,
+                               check_same_thread=False,
+                               cached_statements=CACHED_STATEMENTS)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        register_functions(conn)
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# 首次使用时创建连接池并执行数据库迁移，每个进程只执行一次
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool(DB_PATH)
+                conn = pool.acquire()
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    try:
+                        migrations.migrate(conn)
+                    except BaseException:
+                        conn.execute("ROLLBACK")
+                        raise
+                    conn.execute("COMMIT")
+                finally:
+                    pool.release(conn)
+                _pool = pool
+    return _pool
+
+
+@contextmanager
+def connection() -> Iterator[sqlite3.Connection]:
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+# 写事务：BEGIN IMMEDIATE 在开始时就拿到写锁，避免读锁升级为写锁时的死锁重试
+@contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+# ---------- 用户 ----------
+
+def get_user(username: str) -> Optional[User]:
+    with connection() as conn:
+        row = conn.execute("SELECT username, nickname, phone, role, avatar_path FROM users WHERE username = ?",
+                           (username,)).fetchone()
+    return User(*row) if row else None
+
+
+def get_user_nickname(username: str) -> Optional[str]:
+    with connection() as conn:
+        row = conn.execute("SELECT nickname FROM users WHERE username = ?", (username,)).fetchone()
+    return row[0] if row else None
+
+
+def get_password_hash(username: str) -> Optional[str]:
+    with connection() as conn:
+        row = conn.execute("SELECT password FROM users WHERE username = ?", (username,)).fetchone()
+    return row[0] if row else None
+
+
+# 登录时按新的哈希策略重新哈希后写回
+def update_password_hash(username: str, password_hash: str) -> None:
+    with transaction() as conn:
+        conn.execute("UPDATE users SET password = ? WHERE username = ?", (password_hash, username))
+
+
+# 用户名或手机号重复时抛出 sqlite3.IntegrityError
+def create_user(username: str, nickname: str, phone: str, password_hash: str, role: str,
+                avatar_path: str = "default_avatar.png") -> None:
+    # 群聊机器人的用户ID保留，按用户名已存在处理
+    if username == BOT_USER_ID:
+        raise sqlite3.IntegrityError("UNIQUE constraint failed: users.username")
+    with transaction() as conn:
+        conn.execute("INSERT INTO users (username, nickname, phone, password, role, avatar_path) "
+                     "VALUES (?, ?, ?, ?, ?, ?)",
+                     (username, nickname, phone, password_hash, role, avatar_path))
+
+
+# ---------- 单人对话 ----------
+
+# 创建对话；给出 first_message 时在同一事务中写入第一条用户消息
+def create_conversation(user_id: str, title: str, first_message: Optional[str] = None) -> int:
+    with transaction() as conn:
+        conversation_id = conn.execute("INSERT INTO conversations (user_id, title) VALUES (?, ?)",
+                                       (user_id, title)).lastrowid
+        if first_message is not None:
+            conn.execute("INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
+                         (conversation_id, "user", first_message))
+    return conversation_id
+
+
+def delete_conversation(conversation_id: int) -> None:
+    with transaction() as conn:
+        # 先恢复归档的消息，由触发器一并删除它们的全文索引
+        _restore(conn, conversation_id)
+        conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+        conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+
+def list_conversations(user_id: str) -> List[Conversation]:
+    with connection() as conn:
+        rows = conn.execute("SELECT id, user_id, title, created_at FROM conversations "
+                            "WHERE user_id = ? ORDER BY created_at DESC", (user_id,)).fetchall()
+    return [Conversation(*row) for row in rows]
+
+
+# 对话列表的键集分页：按创建时间倒序，cursor 为上一页最后一条的 (created_at, id)；
+# title_query 非空时只返回标题包含该文本的对话。返回 (对话列表, 下一页游标)，没有下一页时游标为None
+def list_conversations_page(user_id: str, cursor: Optional[Tuple[str, int]] = None, limit: int = 20,
+                            title_query: Optional[str] = None) -> Tuple[List[Conversation], Optional[Tuple[str, int]]]:
+    sql = "SELECT id, user_id, title, created_at FROM conversations WHERE user_id = ?"
+    params = [user_id]
+    if cursor is not None:
+        sql += " AND (created_at, id) < (?, ?)"
+        params.extend(cursor)
+    if title_query:
+        escaped = title_query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        sql += " AND title LIKE ? ESCAPE '\\'"
+        params.append(f"%{escaped}%")
+    # 多取一条用于判断是否还有下一页
+    sql += " ORDER BY created_at DESC, id DESC LIMIT ?"
+    params.append(limit + 1)
+    with connection() as conn:
+        rows = [Conversation(*row) for row in conn.execute(sql, params).fetchall()]
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, (rows[-1].created_at, rows[-1].id)
+
+
+def add_message(conversation_id: int, role: str, content: str) -> int:
+    with transaction() as conn:
+        return conn.execute("INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
+                            (conversation_id, role, content)).lastrowid
+
+
+def list_messages(conversation_id: int) -> List[Message]:
+    ensure_restored(conversation_id)
+    with connection() as conn:
+        rows = conn.execute("SELECT id, conversation_id, role, content, timestamp FROM messages "
+                            "WHERE conversation_id = ? ORDER BY timestamp, id", (conversation_id,)).fetchall()
+    return [Message(*row) for row in rows]
+
+
+# 按ID倒序的键集分页：返回 before_id 之前（不含）最近的至多 limit 条消息，按时间正序排列
+def list_messages_before(conversation_id: int, before_id: Optional[int] = None, limit: int = 50) -> List[Message]:
+    ensure_restored(conversation_id)
+    with connection() as conn:
+        if before_id is None:
+            rows = conn.execute("SELECT id, conversation_id, role, content, timestamp FROM messages "
+                                "WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
+                                (conversation_id, limit)).fetchall()
+        else:
+            rows = conn.execute("SELECT id, conversation_id, role, content, timestamp FROM messages "
+                                "WHERE conversation_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                                (conversation_id, before_id, limit)).fetchall()
+    return [Message(*row) for row in reversed(rows)]
+
+
+# ---------- 冷数据归档 ----------
+
+# 最后一条消息与最近一次恢复都早于 days 天前的对话ID（只看仍在热表中的消息）
+def list_inactive_conversations(days: int, limit: int = 100) -> List[int]:
+    cutoff = f"-{days} days"
+    with connection() as conn:
+        rows = conn.execute("SELECT messages.conversation_id FROM messages "
+                            "JOIN conversations ON conversations.id = messages.conversation_id "
+                            "WHERE conversations.last_active_at IS NULL "
+                            "OR conversations.last_active_at < datetime('now', ?) "
+                            "GROUP BY messages.conversation_id "
+                            "HAVING MAX(messages.timestamp) < datetime('now', ?) LIMIT ?",
+                            (cutoff, cutoff, limit)).fetchall()
+    return [row[0] for row in rows]
+
+
+def _decode_chunk(data):
+    return json.loads(zstandard.ZstdDecompressor().decompress(data))
+
+
+# 把对话的消息压缩成块移入 message_archive，与删除热表消息在同一事务中完成；返回归档的消息数
+# 消息先登记到 archived_messages，删除时触发器保留它们的全文索引，归档后仍可检索
+def archive_conversation(conversation_id: int) -> int:
+    compressor = zstandard.ZstdCompressor(level=ARCHIVE_ZSTD_LEVEL)
+    with transaction() as conn:
+        rows = conn.execute("SELECT id, role, content, timestamp FROM messages "
+                            "WHERE conversation_id = ? ORDER BY id", (conversation_id,)).fetchall()
+        if not rows:
+            return 0
+        # 已有归档块时（例如未读取过又有新消息）接在后面
+        next_chunk = conn.execute("SELECT COALESCE(MAX(chunk) + 1, 0) FROM message_archive "
+                                  "WHERE conversation_id = ?", (conversation_id,)).fetchone()[0]
+        for i in range(0, len(rows), ARCHIVE_CHUNK_MESSAGES):
+            chunk = [tuple(row) for row in rows[i:i + ARCHIVE_CHUNK_MESSAGES]]
+            chunk_no = next_chunk + i // ARCHIVE_CHUNK_MESSAGES
+            data = compressor.compress(json.dumps(chunk, ensure_ascii=False).encode("utf-8"))
+            conn.execute("INSERT INTO message_archive (conversation_id, chunk, message_count, data) "
+                         "VALUES (?, ?, ?, ?)", (conversation_id, chunk_no, len(chunk), data))
+            conn.executemany("INSERT INTO archived_messages (id, conversation_id, chunk) VALUES (?, ?, ?)",
+                             [(row[0], conversation_id, chunk_no) for row in chunk])
+        conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+    return len(rows)
+
+
+# 在调用方的写事务中把归档的消息按原ID写回热表，并记录恢复时间，返回恢复的消息数
+# ID不变，分页游标照常可用；写回时 archived_messages 仍有记录，触发器不会重复建立全文索引
+def _restore(conn, conversation_id):
+    chunks = conn.execute("SELECT data FROM message_archive WHERE conversation_id = ? ORDER BY chunk",
+                          (conversation_id,)).fetchall()
+    if not chunks:
+        return 0
+    rows = [(message_id, conversation_id, role, content, timestamp)
+            for (data,) in chunks
+            for message_id, role, content, timestamp in _decode_chunk(data)]
+    conn.executemany("INSERT INTO messages (id, conversation_id, role, content, timestamp) "
+                     "VALUES (?, ?, ?, ?, ?)", rows)
+    conn.execute("DELETE FROM archived_messages WHERE conversation_id = ?", (conversation_id,))
+    conn.execute("DELETE FROM message_archive WHERE conversation_id = ?", (conversation_id,))
+    # 刚恢复的对话在 days 天内不会再被归档
+    conn.execute("UPDATE conversations SET last_active_at = CURRENT_TIMESTAMP WHERE id = ?", (conversation_id,))
+    return len(rows)
+
+
+def restore_conversation(conversation_id: int) -> int:
+    with transaction() as conn:
+        return _restore(conn, conversation_id)
+
+
+# 读取对话消息前调用：对话已归档时透明地恢复；未归档时只多一次主键查询
+def ensure_restored(conversation_id: int) -> None:
+    with connection() as conn:
+        archived = conn.execute("SELECT 1 FROM message_archive WHERE conversation_id = ? LIMIT 1",
+                                (conversation_id,)).fetchone()
+    if archived:
+        restore_conversation(conversation_id)
+
+
+# ---------- 群聊 ----------
+
+def generate_unique_invite_code() -> str:
+    with connection() as conn:
+        while True:
+            invite_code = "".join(random.choices(string.ascii_uppercase + string.digits, k=6))
+            if not conn.execute("SELECT 1 FROM group_chats WHERE invite_code = ?", (invite_code,)).fetchone():
+                return invite_code
+
+
+# 创建群聊并把创建者加入群聊，返回群聊ID
+def create_group_chat(title: str, invite_code: str, owner: str) -> int:
+    with transaction() as conn:
+        group_id = conn.execute("INSERT INTO group_chats (title, invite_code) VALUES (?, ?)",
+                                (title, invite_code)).lastrowid
+        conn.execute("INSERT INTO user_group_chats (user_id, group_chat_id) VALUES (?, ?)",
+                     (owner, group_id))
+    return group_id
+
+
+def get_group_chat(group_id: int) -> Optional[GroupChat]:
+    with connection() as conn:
+        row = conn.execute("SELECT id, title, invite_code, created_at FROM group_chats WHERE id = ?",
+                           (group_id,)).fetchone()
+    return GroupChat(*row) if row else None
+
+
+def get_group_chat_by_invite_code(invite_code: str) -> Optional[GroupChat]:
+    with connection() as conn:
+        row = conn.execute("SELECT id, title, invite_code, created_at FROM group_chats WHERE invite_code = ?",
+                           (invite_code,)).fetchone()
+    return GroupChat(*row) if row else None
+
+
+def list_user_group_chats(user_id: str) -> List[GroupChat]:
+    with connection() as conn:
+        rows = conn.execute("SELECT group_chats.id, group_chats.title, group_chats.invite_code, "
+                            "group_chats.created_at FROM group_chats "
+                            "JOIN user_group_chats ON group_chats.id = user_group_chats.group_chat_id "
+                            "WHERE user_group_chats.user_id = ?", (user_id,)).fetchall()
+    return [GroupChat(*row) for row in rows]
+
+
+def is_group_member(user_id: str, group_id: int) -> bool:
+    with connection() as conn:
+        return conn.execute("SELECT 1 FROM user_group_chats WHERE user_id = ? AND group_chat_id = ?",
+                            (user_id, group_id)).fetchone() is not None
+
+
+# 加入群聊，已在群中时返回False
+def join_group_chat(user_id: str, group_id: int) -> bool:
+    with transaction() as conn:
+        # (user_id, group_chat_id) 为复合主键，重复加入时不插入
+        return conn.execute("INSERT OR IGNORE INTO user_group_chats (user_id, group_chat_id) VALUES (?, ?)",
+                            (user_id, group_id)).rowcount == 1
+
+
+def add_group_message(group_id: int, user_id: str, content: str, msg_id: Optional[str] = None) -> int:
+    with transaction() as conn:
+        return conn.execute("INSERT INTO group_messages (group_id, user_id, content, msg_id) VALUES (?, ?, ?, ?)",
+                            (group_id, user_id, content, msg_id)).lastrowid
+
+
+# 批量写入群聊消息，rows 为 (group_id, user_id, content, msg_id) 序列，在一个事务中提交
+def add_group_messages(rows) -> None:
+    with transaction() as conn:
+        conn.executemany("INSERT INTO group_messages (group_id, user_id, content, msg_id) VALUES (?, ?, ?, ?)",
+                         rows)
+
+
+def list_group_messages(group_id: int) -> List[GroupMessage]:
+    with connection() as conn:
+        rows = conn.execute("SELECT id, group_id, user_id, content, msg_id, timestamp FROM group_messages "
+                            "WHERE group_id = ? ORDER BY timestamp, id", (group_id,)).fetchall()
+    return [GroupMessage(*row) for row in rows]
+
+
+# 增量同步：返回ID大于 after_id 的至多 limit 条消息，按ID升序
+# 写入是串行提交的，自增ID的顺序即提交顺序，游标不会跳过晚提交的消息
+def list_group_messages_after(group_id: int, after_id: int = 0, limit: int = 200) -> List[GroupMessage]:
+    with connection() as conn:
+        rows = conn.execute("SELECT id, group_id, user_id, content, msg_id, timestamp FROM group_messages "
+                            "WHERE group_id = ? AND id > ? ORDER BY id LIMIT ?",
+                            (group_id, after_id, limit)).fetchall()
+    return [GroupMessage(*row) for row in rows]
+
+
+# 断线补发：返回群聊中 msg_id 之后的至多 limit 条消息；msg_id 不存在时返回空列表
+def list_group_messages_since(group_id: int, msg_id: str, limit: int = 200) -> List[GroupMessage]:
+    with connection() as conn:
+        rows = conn.execute("SELECT id, group_id, user_id, content, msg_id, timestamp FROM group_messages "
+                            "WHERE group_id = ? AND id > (SELECT id FROM group_messages WHERE group_id = ? AND msg_id = ?) "
+                            "ORDER BY id LIMIT ?", (group_id, group_id, msg_id, limit)).fetchall()
+    return [GroupMessage(*row) for row in rows]
+
+
+# ---------- 全文检索 ----------
+
+# resolve(conn, rows) 在同一连接中补全查询结果（如从归档块中取出原文）
+def _search(sql, params, query, limit, offset, resolve=None) -> List[SearchHit]:
+    match = fulltext.match_expression(query)
+    if match is None:
+        return []
+    with connection() as conn:
+        rows = conn.execute(sql, (match, *params, limit, offset)).fetchall()
+        if resolve is not None:
+            rows = resolve(conn, rows)
+    # bm25 越小越相关，取反后分数越大越相关
+    return [SearchHit(row_id, parent_id, author, fulltext.make_snippet(content, query), timestamp, -rank)
+            for row_id, parent_id, author, content, timestamp, rank in rows]
+
+
+# 归档消息的命中只有块位置：解压本页命中涉及的块，取出原文、角色和时间
+def _resolve_archived(conn, rows):
+    chunks = {}
+    resolved = []
+    for row_id, conversation_id, role, content, timestamp, rank, chunk in rows:
+        if content is None:
+            key = (conversation_id, chunk)
+            if key not in chunks:
+                data = conn.execute("SELECT data FROM message_archive WHERE conversation_id = ? AND chunk = ?",
+                                    key).fetchone()
+                chunks[key] = {message[0]: message for message in _decode_chunk(data[0])} if data else {}
+            message = chunks[key].get(row_id)
+            if message is None:
+                # 两次查询之间对话恰好被恢复或删除
+                continue
+            _, role, content, timestamp = message
+        resolved.append((row_id, conversation_id, role, content, timestamp, rank))
+    return resolved
+
+
+# 检索用户自己的单人对话消息（包括已归档的），按相关度排序分页
+def search_messages(user_id: str, query: str, limit: int = 20, offset: int = 0) -> List[SearchHit]:
+    return _search("SELECT messages_fts.rowid, "
+                   "COALESCE(messages.conversation_id, archived_messages.conversation_id) AS conversation_id, "
+                   "messages.role, messages.content, messages.timestamp, bm25(messages_fts) AS rank, "
+                   "archived_messages.chunk FROM messages_fts "
+                   "LEFT JOIN messages ON messages.id = messages_fts.rowid "
+                   "LEFT JOIN archived_messages ON archived_messages.id = messages_fts.rowid "
+                   "JOIN conversations ON conversations.id = "
+                   "COALESCE(messages.conversation_id, archived_messages.conversation_id) "
+                   "WHERE messages_fts MATCH ? AND conversations.user_id = ? "
+                   "ORDER BY rank LIMIT ? OFFSET ?", (user_id,), query, limit, offset, _resolve_archived)
+
+
+# 检索用户所在群聊的消息，按相关度排序分页
+def search_group_messages(user_id: str, query: str, limit: int = 20, offset: int = 0) -> List[SearchHit]:
+    return _search("SELECT group_messages.id, group_messages.group_id, group_messages.user_id, "
+                   "group_messages.content, group_messages.timestamp, bm25(group_messages_fts) AS rank "
+                   "FROM group_messages_fts "
+                   "JOIN group_messages ON group_messages.id = group_messages_fts.rowid "
+                   "JOIN user_group_chats ON user_group_chats.group_chat_id = group_messages.group_id "
+                   "WHERE group_messages_fts MATCH ? AND user_group_chats.user_id = ? "
+                   "ORDER BY rank LIMIT ? OFFSET ?", (user_id,), query, limit, offset)
@@ -0,0 +1,105 @@
+import asyncio
+import os
+from rag_engine import embed_texts
+
+# 微批处理配置：最多攒 MAX_SIZE 个查询，或最早的查询等待 MAX_WAIT_MS 毫秒后立即处理
+BATCH_MAX_SIZE = int(os.environ.get("EMBED_BATCH_MAX_SIZE", "32"))
+BATCH_MAX_WAIT_MS = float(os.environ.get("EMBED_BATCH_MAX_WAIT_MS", "5"))
+
+
+# 在线程池中为一批查询打分：同一知识库的查询用一次矩阵-矩阵乘法打分（再各自与BM25结果融合）
+# batch 中每项为 (知识库, 查询文本, top_k, score_threshold, ...)，vectors 为对应的查询向量
+def score_batch(batch, vectors):
+    groups = {}
+    for i, item in enumerate(batch):
+        groups.setdefault(id(item[0]), []).append(i)
+
+    results = [None] * len(batch)
+    for rows in groups.values():
+        kb = batch[rows[0]][0]
+        hits = kb.search(vectors[rows],
+                         [batch[i][2] for i in rows],
+                         [batch[i][3] for i in rows],
+                         texts=[batch[i][1] for i in rows])
+        for i, row_hits in zip(rows, hits):
+            results[i] = row_hits
+    return results
+
+
+class QueryBatcher:
+    def __init__(self, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = None
+        self._task = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        while not self.queue.empty():
+            future = self.queue.get_nowait()[-1]
+            if not future.done():
+                future.cancel()
+
+    # 提交一个查询，返回 (查询向量, [(文档下标, 相似度), ...], 缓存内容)
+    # lookup(查询向量) 在嵌入之后、检索之前于事件循环线程中调用（如语义缓存查找），
+    # 返回非None时跳过检索，检索结果为None
+    async def submit(self, kb, text, top_k, score_threshold, lookup=None):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((kb, text, top_k, score_threshold, lookup, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # 等待期间已断开的请求不再处理
+        return [item for item in batch if not item[-1].done()]
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            try:
+                # 1. 一次调用完成整批嵌入
+                vectors = await asyncio.to_thread(embed_texts, [item[1] for item in batch])
+                # 2. 逐个查缓存；缓存不是线程安全的，与写入一样在事件循环线程中访问
+                cached = [item[4](vectors[i]) if item[4] is not None else None
+                          for i, item in enumerate(batch)]
+                # 3. 只对未命中的查询批量检索
+                misses = [i for i, entry in enumerate(cached) if entry is None]
+                hits = [None] * len(batch)
+                if misses:
+                    scored = await asyncio.to_thread(score_batch, [batch[i] for i in misses], vectors[misses])
+                    for i, row_hits in zip(misses, scored):
+                        hits[i] = row_hits
+            except Exception as e:
+                for item in batch:
+                    if not item[-1].done():
+                        item[-1].set_exception(e)
+                continue
+            for i, item in enumerate(batch):
+                if not item[-1].done():
+                    item[-1].set_result((vectors[i], hits[i], cached[i]))
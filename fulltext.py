@@ -0,0 +1,44 @@
+import re
+from sparse_index import tokenize
+
+# 全文检索的分词：沿用知识库BM25的规则（LaTeX命令和数学符号整体成词、连续汉字切二元组），
+# 另外为每个汉字单独建索引，使单字查询也能命中。FTS5 表使用 unicode61 分词器按空格切分，
+# 因此不是纯字母数字的词（LaTeX命令、数学符号、小数）编码为 0x 开头的十六进制，不会与普通单词或数字混淆
+# 修改分词规则后需要新增迁移重建 FTS 表：无内容表删除索引时依赖与写入时相同的分词结果
+_WORD_RE = re.compile(r"\w+")
+_CJK_RE = re.compile(r"[一-鿿㐀-䶿]")
+SNIPPET_WIDTH = 60
+
+
+def _encode(token):
+    return token if _WORD_RE.fullmatch(token) else "0x" + token.encode("utf-8").hex()
+
+
+# 注册为 SQLite 函数，由触发器在写入 messages / group_messages 时调用
+def fts_tokens(text):
+    if not text:
+        return ""
+    tokens = [_encode(token) for token in tokenize(text)]
+    tokens.extend(_CJK_RE.findall(text))
+    return " ".join(tokens)
+
+
+# 查询文本转换为 FTS5 MATCH 表达式：所有词都须出现；没有可检索的词时返回None
+def match_expression(query):
+    tokens = list(dict.fromkeys(_encode(token) for token in tokenize(query)))
+    if not tokens:
+        return None
+    return " AND ".join(f'"{token}"' for token in tokens)
+
+
+# 从原文中截取包含查询词的片段并加粗命中的词
+def make_snippet(content, query, width=SNIPPET_WIDTH):
+    terms = sorted({token for token in tokenize(query)}, key=len, reverse=True)
+    if not terms:
+        return content[:width]
+    pattern = re.compile("|".join(re.escape(term) for term in terms), re.IGNORECASE)
+    match = pattern.search(content)
+    start = max(0, match.start() - width // 3) if match else 0
+    end = min(len(content), start + width)
+    snippet = pattern.sub(lambda m: f"**{m.group()}**", content[start:end])
+    return ("…" if start > 0 else "") + snippet + ("…" if end < len(content) else "")
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import os
+import uuid
+from datetime import datetime
+from starlette.concurrency import iterate_in_threadpool
+import context_builder
+from config import BOT_USER_ID
+from rag_engine import engine, get_knowledge_base
+
+# 群聊中 @数学帮帮 的提问由服务端排队回答：有界队列 + 固定数量的worker，回答按块流式广播给整个群聊
+BOT_MENTION = "@数学帮帮"
+BOT_WORKERS = int(os.environ.get("GROUP_BOT_WORKERS", "2"))
+BOT_QUEUE_SIZE = int(os.environ.get("GROUP_BOT_QUEUE_SIZE", "32"))
+BOT_KNOWLEDGE_BASE = "math"
+BOT_TOP_K = 3
+BOT_SCORE_THRESHOLD = 0.85
+# 流式片段帧以固定前缀开头，广播时据此不放入重连补发缓冲（完整回答另有一条普通消息帧）
+STREAM_FRAME_PREFIX = '{"type": "bot_chunk"'
+
+
+def mentions_bot(content):
+    return BOT_MENTION in content
+
+
+class GroupBot:
+    # publish(group_id, message) 为群聊广播，batcher 为 QueryBatcher，writer 为 GroupMessageWriter
+    def __init__(self, publish, batcher, writer, workers=BOT_WORKERS, queue_size=BOT_QUEUE_SIZE):
+        self.publish = publish
+        self.batcher = batcher
+        self.writer = writer
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queue = None
+        self._tasks = []
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # 非阻塞提交，排队已满时返回False
+    def submit(self, group_id, content, history=None):
+        question = content.replace(BOT_MENTION, "").strip()
+        try:
+            self.queue.put_nowait((group_id, question, history or []))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._answer(*job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"群聊机器人回答失败: {e}")
+
+    async def _answer(self, group_id, question, history):
+        stream_id = str(uuid.uuid4())
+        # 群聊历史按 token 预算裁剪，较早的消息折叠为按群聊缓存的摘要
+        history = await asyncio.to_thread(context_builder.builder.build, ("group", group_id), history)
+        kb = get_knowledge_base(BOT_KNOWLEDGE_BASE)
+        if kb is None:
+            chunks = iter([f"未找到知识库 {BOT_KNOWLEDGE_BASE}"])
+        else:
+            _, hits, _ = await self.batcher.submit(kb, question, BOT_TOP_K, BOT_SCORE_THRESHOLD)
+            chunks = engine.generate(question, engine.hits_to_docs(kb, hits), history)
+
+        parts = []
+        async for chunk in iterate_in_threadpool(chunks):
+            parts.append(chunk)
+            await self.publish(group_id, json.dumps({"type": "bot_chunk", "stream_id": stream_id, "content": chunk},
+                                                    ensure_ascii=False))
+        answer = "".join(parts)
+
+        # 生成期间不持有任何数据库事务，完整回答生成后才交给写线程
+        committed = self.writer.enqueue(group_id, BOT_USER_ID, answer, stream_id)
+        committed.add_done_callback(lambda f: f.cancelled() or f.exception())
+        await self.publish(group_id, {
+            "type": "message",
+            "msg_id": stream_id,
+            "user_id": BOT_USER_ID,
+            "username": BOT_USER_ID,
+            "content": answer,
+            "group_id": group_id,
+            "timestamp": datetime.now().isoformat()
+        })
@@ -0,0 +1,186 @@
+import asyncio
+import concurrent.futures
+import json
+import queue
+import threading
+import uuid
+from datetime import datetime
+from urllib.parse import urlencode
+import requests
+import websockets
+from config import SERVER_URL
+
+# 页面访问 server.py 群聊接口的客户端
+SYNC_PAGE_SIZE = 200
+SYNC_TIMEOUT = 5
+
+
+# 从游标 after 开始拉取群聊的全部新消息，返回 (消息列表, 新游标)；token 为登录时签发的会话令牌
+# 每条消息为 {"id", "group_id", "user_id", "content", "msg_id", "timestamp"}
+def sync_group_messages(group_id, after=0, token=None, session=None):
+    http = session or requests
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    messages = []
+    while True:
+        response = http.get(f"{SERVER_URL}/groups/{group_id}/messages",
+                            params={"after": after, "limit": SYNC_PAGE_SIZE},
+                            headers=headers, timeout=SYNC_TIMEOUT)
+        response.raise_for_status()
+        page = response.json()
+        messages.extend(page["messages"])
+        after = page["next_after"]
+        if not page["has_more"]:
+            return messages, after
+
+
+WS_URL = SERVER_URL.replace("http", "ws", 1)
+RECONNECT_DELAY = 3
+
+
+ACK_TIMEOUT = 10
+# 没有新消息时检查 is_wanted 的间隔（秒）
+WANTED_CHECK_INTERVAL = 30
+
+
+# 每个 Streamlit 会话一条长连接，在后台线程自己的事件循环中收发群聊消息
+# 收到的聊天帧放入线程安全的缓冲区，由页面重跑时取出；缓冲区由空变为非空时调用 on_message（用于触发页面重跑），
+# 一批连续到达的消息只触发一次。发送不必等待前一条的确认，服务端按 msg_id 回复确认帧
+# is_wanted() 返回False时（页面会话已结束）连接自行关闭：收到消息时检查，空闲时每 WANTED_CHECK_INTERVAL 秒检查一次
+# token 为登录时签发的会话令牌，服务端据此确认发送者并只允许群成员连接
+class GroupConnection:
+    def __init__(self, group_id, on_message=None, is_wanted=None, token=None):
+        self.group_id = group_id
+        self.token = token
+        self.on_message = on_message
+        self.is_wanted = is_wanted
+        self.closed = False
+        self.buffer = queue.SimpleQueue()
+        self._loop = asyncio.new_event_loop()
+        self._outbox = asyncio.Queue()
+        # msg_id -> 等待确认的 concurrent.futures.Future
+        self._pending = {}
+        # 最后收到的聊天消息，重连时服务端从它之后补发
+        self.last_msg_id = None
+        self._task = None
+        self._thread = threading.Thread(target=self._run, name=f"group-connection-{group_id}", daemon=True)
+
+    def start(self):
+        self._task = self._loop.create_task(self._connect_loop())
+        self._thread.start()
+
+    # 可以在连接线程内部调用（如 on_message 回调中），此时不等待线程退出
+    def stop(self, timeout=None):
+        self.closed = True
+        if self._thread.is_alive():
+            self._loop.call_soon_threadsafe(self._task.cancel)
+            if threading.current_thread() is not self._thread:
+                self._thread.join(timeout)
+
+    # 在页面线程中调用：消息交给连接线程发送后立即返回 (msg_id, future)，
+    # 消息写入数据库并广播后 future 的结果为 "ok"，写入失败为 "error"；连接断开时抛出 ConnectionError
+    def send(self, user_id, content):
+        msg_id = str(uuid.uuid4())
+        payload = json.dumps({
+            "msg_id": msg_id,
+            "type": "message",
+            "user_id": user_id,
+            "username": user_id,
+            "content": content,
+            "group_id": str(self.group_id),
+            "timestamp": datetime.now().isoformat()
+        }, ensure_ascii=False)
+        future = concurrent.futures.Future()
+        self._pending[msg_id] = future
+        self._loop.call_soon_threadsafe(self._outbox.put_nowait, payload)
+        return msg_id, future
+
+    # 取出缓冲区中的全部帧
+    def drain(self):
+        frames = []
+        while True:
+            try:
+                frames.append(self.buffer.get_nowait())
+            except queue.Empty:
+                return frames
+
+    def _run(self):
+        try:
+            self._loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._fail_pending()
+            self._loop.close()
+
+    def _wanted(self):
+        if self.is_wanted is None or self.is_wanted():
+            return True
+        self.stop()
+        return False
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(WANTED_CHECK_INTERVAL)
+            if not self._wanted():
+                # stop() 已安排取消，与外部调用 stop() 一样在下一次等待时退出
+                continue
+
+    async def _connect_loop(self):
+        watcher = asyncio.create_task(self._watch())
+        try:
+            await self._reconnect_loop()
+        finally:
+            watcher.cancel()
+
+    async def _reconnect_loop(self):
+        uri = f"{WS_URL}/ws/{self.group_id}"
+        while True:
+            try:
+                params = {"token": self.token or ""}
+                if self.last_msg_id:
+                    params["last_msg_id"] = self.last_msg_id
+                async with websockets.connect(f"{uri}?{urlencode(params)}") as websocket:
+                    sender = asyncio.create_task(self._send_loop(websocket))
+                    try:
+                        await self._receive_loop(websocket)
+                    finally:
+                        sender.cancel()
+            except (OSError, websockets.WebSocketException) as e:
+                if isinstance(e, websockets.InvalidStatus) and e.response.status_code == 403:
+                    # 令牌无效或不是群成员，握手被拒绝，重连也不会成功
+                    print(f"群聊连接被拒绝: {e}")
+                    self.closed = True
+                    return
+                print(f"连接错误: {e}")
+            # 已发出但未确认的消息状态未知，交给页面提示用户
+            self._fail_pending()
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _send_loop(self, websocket):
+        while True:
+            await websocket.send(await self._outbox.get())
+
+    async def _receive_loop(self, websocket):
+        async for message in websocket:
+            frame = json.loads(message)
+            if frame.get("type") == "ack":
+                future = self._pending.pop(frame.get("msg_id"), None)
+                if future is not None:
+                    future.set_result(frame.get("status"))
+                continue
+            if not self._wanted():
+                # stop() 已安排取消，与外部调用 stop() 一样在下一次等待时退出
+                continue
+            if frame.get("msg_id"):
+                self.last_msg_id = frame["msg_id"]
+            was_empty = self.buffer.empty()
+            self.buffer.put(frame)
+            if was_empty and self.on_message is not None:
+                self.on_message()
+
+    def _fail_pending(self):
+        while not self._outbox.empty():
+            self._outbox.get_nowait()
+        while self._pending:
+            _, future = self._pending.popitem()
+            future.set_exception(ConnectionError("与服务器的连接已断开"))
@@ -0,0 +1,153 @@
+import argparse
+import hashlib
+import os
+import time
+import numpy as np
+from langchain_text_splitters import LatexTextSplitter, MarkdownTextSplitter, RecursiveCharacterTextSplitter
+import vector_index
+from sparse_index import SparseIndex
+from rag_engine import EMBED_DIM, INDEX_DTYPE, embed_texts, kb_content_dir, kb_store_dir
+
+# 增量入库：按文件内容哈希跳过未修改的文件，按分块内容哈希去重，只有新增的分块才需要嵌入
+KB_SUFFIXES = (".md", ".tex", ".txt")
+CHUNK_SIZE = 300
+CHUNK_OVERLAP = 30
+EMBED_BATCH_SIZE = 256
+# 已删除行占比超过该值时整体重写索引，回收空间
+COMPACT_RATIO = 0.3
+
+_splitters = {
+    ".md": MarkdownTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP),
+    ".tex": LatexTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP),
+    ".txt": RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                                           separators=["\n\n", "\n", "。", "；", "，", " ", ""]),
+}
+
+
+def split_text(text, suffix):
+    return [chunk.strip() for chunk in _splitters[suffix].split_text(text) if chunk.strip()]
+
+
+# 分块哈希忽略空白差异，不同教材中重复的段落只存一份
+def chunk_hash(chunk):
+    return hashlib.sha1(" ".join(chunk.split()).encode("utf-8")).hexdigest()
+
+
+def scan_files(content_dir):
+    files = []
+    for root, _, names in os.walk(content_dir):
+        for name in names:
+            if name.endswith(KB_SUFFIXES):
+                files.append(os.path.relpath(os.path.join(root, name), content_dir))
+    return sorted(files)
+
+
+def _embed(contents):
+    if not contents:
+        return np.zeros((0, EMBED_DIM), dtype=np.float32)
+    return np.concatenate([embed_texts(contents[i:i + EMBED_BATCH_SIZE])
+                           for i in range(0, len(contents), EMBED_BATCH_SIZE)])
+
+
+# 对知识库执行一次入库，返回统计信息；持有入库锁，与其他进程的入库串行执行
+def ingest(kb_name, dtype=None, full=False):
+    with vector_index.index_lock(kb_store_dir(kb_name)):
+        return _ingest(kb_name, dtype, full)
+
+
+def _ingest(kb_name, dtype=None, full=False):
+    content_dir = kb_content_dir(kb_name)
+    store = kb_store_dir(kb_name)
+    meta, matrix, contents = vector_index.open_index(store)
+    dtype = dtype or (meta["dtype"] if meta else INDEX_DTYPE)
+    if meta is not None and (full or meta["dim"] != EMBED_DIM or meta["dtype"] != dtype):
+        full = True
+    old_docs = meta["docs"] if meta and not full else []
+    old_files = meta.get("files", {}) if meta and not full else {}
+
+    # 1. 对比文件哈希，只重新切分修改过的文件
+    files = {}
+    new_chunks = {}
+    changed_files = 0
+    for rel in scan_files(content_dir):
+        with open(os.path.join(content_dir, rel), "rb") as f:
+            data = f.read()
+        file_hash = hashlib.sha256(data).hexdigest()
+        if old_files.get(rel, {}).get("sha256") == file_hash:
+            files[rel] = old_files[rel]
+            continue
+        changed_files += 1
+        hashes = []
+        for chunk in split_text(data.decode("utf-8"), os.path.splitext(rel)[1]):
+            h = chunk_hash(chunk)
+            new_chunks.setdefault(h, chunk)
+            hashes.append(h)
+        files[rel] = {"sha256": file_hash, "chunks": hashes}
+
+    # 2. 汇总每个分块的出处，找出新增和不再被引用的分块
+    sources = {}
+    for rel, info in files.items():
+        for h in info["chunks"]:
+            sources.setdefault(h, [])
+            if rel not in sources[h]:
+                sources[h].append(rel)
+    rows = {doc["hash"]: i for i, doc in enumerate(old_docs) if doc}
+    added = [h for h in sources if h not in rows]
+    removed = [i for h, i in rows.items() if h not in sources]
+    stats = {"files": len(files), "changed_files": changed_files,
+             "added": len(added), "removed": len(removed)}
+    # 旧格式的索引（原文存放在元数据中）即使没有变化也改写一次
+    legacy = meta is not None and "contents_file" not in meta
+    if meta is not None and not full and not legacy and not added and not removed and files == old_files:
+        return dict(stats, version=meta["version"])
+
+    # 3. 只对新增分块做嵌入；原文单独存放，元数据中只保留哈希与出处
+    added_contents = [new_chunks[h] for h in added]
+    new_embeddings = _embed(added_contents)
+    docs = [{"hash": doc["hash"], "sources": sources[doc["hash"]]} if doc and doc["hash"] in sources else None
+            for doc in old_docs]
+    docs += [{"hash": h, "sources": sources[h]} for h in added]
+
+    dead = sum(doc is None for doc in docs)
+    if meta is None or full or legacy or dead > COMPACT_RATIO * len(docs):
+        live = [i for i, doc in enumerate(old_docs) if doc and doc["hash"] in sources]
+        old_rows = np.asarray(matrix[live], dtype=np.float32) if live else np.zeros((0, EMBED_DIM), np.float32)
+        texts = [contents[i] for i in live] + added_contents
+        new_meta = vector_index.save_index(store, [docs[i] for i in live] + docs[len(old_docs):], texts,
+                                           np.concatenate([old_rows, new_embeddings]), dtype, files=files)
+    else:
+        new_meta = vector_index.update_index(store, meta, docs, added_contents, new_embeddings, removed,
+                                             files=files)
+        texts = [contents[i] if doc else None for i, doc in enumerate(docs[:len(old_docs)])] + added_contents
+    # 倒排索引只做分词和计数，随向量索引每个版本整体重建
+    SparseIndex.build(texts).save(store, new_meta["version"])
+    return dict(stats, version=new_meta["version"])
+
+
+def _index_stale(meta):
+    return meta is None or meta["dim"] != EMBED_DIM or "contents_file" not in meta
+
+
+# 索引不存在时（首次启动）构建一次；旧格式的索引改写为原文单独存放的格式，不需要重新嵌入
+# 多个 worker 同时启动时只有第一个拿到锁的进程构建，其余进程拿到锁后重新检查，发现已构建即返回
+def ensure_index(kb_name):
+    store = kb_store_dir(kb_name)
+    if not _index_stale(vector_index.read_meta(store)) or not os.path.isdir(kb_content_dir(kb_name)):
+        return
+    with vector_index.index_lock(store):
+        if _index_stale(vector_index.read_meta(store)):
+            _ingest(kb_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="知识库增量入库")
+    parser.add_argument("kb_name", nargs="?", default="math")
+    parser.add_argument("--dtype", choices=sorted(vector_index.DTYPES), default=None)
+    parser.add_argument("--full", action="store_true", help="忽略已有索引，全部重新嵌入")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    result = ingest(args.kb_name, dtype=args.dtype, full=args.full)
+    print(f"[{args.kb_name}] 文件 {result['files']} 个（修改 {result['changed_files']} 个），"
+          f"新增分块 {result['added']} 个，删除分块 {result['removed']} 个，"
+          f"索引版本 v{result['version']}，耗时 {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,95 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+import db
+
+# 群聊消息延迟批量写入：攒够 BATCH_SIZE 条或距第一条消息超过 FLUSH_INTERVAL_MS 毫秒时在一个事务中提交
+BATCH_SIZE = int(os.environ.get("GROUP_MESSAGE_BATCH_SIZE", "64"))
+FLUSH_INTERVAL_MS = float(os.environ.get("GROUP_MESSAGE_FLUSH_MS", "5"))
+
+_STOP = object()
+
+
+def _resolve(future, error):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+
+
+# 独立的写线程：事件循环只负责入队，SQLite 提交和 fsync 不再阻塞其他 WebSocket
+class GroupMessageWriter:
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval_ms=FLUSH_INTERVAL_MS):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="group-message-writer", daemon=True)
+        self._thread.start()
+
+    # 停止前写完队列中剩余的消息
+    def stop(self, timeout=None):
+        if self._thread is None:
+            return
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    # 在事件循环中调用：消息入队后立即返回，返回的 future 在消息提交后完成
+    def enqueue(self, group_id, user_id, content, msg_id=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.put(((group_id, user_id, content, msg_id), loop, future))
+        return future
+
+    def _collect(self):
+        first = self.queue.get()
+        if first is _STOP:
+            return None, True
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._collect()
+            if not batch:
+                continue
+            try:
+                db.add_group_messages([row for row, _, _ in batch])
+                errors = [None] * len(batch)
+            except Exception as e:
+                # 整批回滚后逐条重试，只有出错的那条消息失败
+                print(f"群聊消息批量写入失败，逐条重试: {e}")
+                errors = [self._write_one(row) for row, _, _ in batch]
+            for (_, loop, future), error in zip(batch, errors):
+                try:
+                    loop.call_soon_threadsafe(_resolve, future, error)
+                except RuntimeError:
+                    # 事件循环已关闭（服务正在退出）
+                    pass
+
+    @staticmethod
+    def _write_one(row):
+        try:
+            db.add_group_messages([row])
+        except Exception as e:
+            print(f"群聊消息写入失败: {e}")
+            return e
+        return None
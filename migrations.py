@@ -0,0 +1,192 @@
+import json
+import zstandard
+
+# 数据库迁移：用 PRAGMA user_version 记录已执行到的版本，每个进程启动时只执行一次尚未执行的迁移
+# 新的表结构变更在 MIGRATIONS 末尾追加，不要修改已发布的迁移
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+# 1. 基础表结构（此前分散在 app.py 和两个页面中）
+def _create_base_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS users
+                    (username TEXT PRIMARY KEY,
+                     nickname TEXT NOT NULL,
+                     phone TEXT UNIQUE NOT NULL,
+                     password TEXT NOT NULL,
+                     role TEXT NOT NULL,
+                     avatar_path TEXT NOT NULL DEFAULT 'default_avatar.png')''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS conversations
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     user_id TEXT NOT NULL,
+                     title TEXT NOT NULL,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     FOREIGN KEY(user_id) REFERENCES users(username))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS messages
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     conversation_id INTEGER NOT NULL,
+                     role TEXT NOT NULL,
+                     content TEXT NOT NULL,
+                     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     FOREIGN KEY(conversation_id) REFERENCES conversations(id))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS group_chats
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     title TEXT NOT NULL,
+                     invite_code TEXT NOT NULL,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_group_chats
+                    (user_id TEXT NOT NULL,
+                     group_chat_id INTEGER NOT NULL,
+                     FOREIGN KEY(user_id) REFERENCES users(username),
+                     FOREIGN KEY(group_chat_id) REFERENCES group_chats(id))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS group_messages
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     group_id INTEGER NOT NULL,
+                     user_id TEXT NOT NULL,
+                     content TEXT NOT NULL,
+                     timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     FOREIGN KEY(group_id) REFERENCES group_chats(id))''')
+
+
+# 2. group_messages 补上 server.py 和 group_chat.py 写入的 msg_id 列
+def _add_group_message_msg_id(conn):
+    if "msg_id" not in _columns(conn, "group_messages"):
+        conn.execute("ALTER TABLE group_messages ADD COLUMN msg_id TEXT")
+
+
+# 3. 邀请码唯一：已有的重复邀请码保留最早的一个，其余改为带ID后缀
+def _unique_invite_code(conn):
+    conn.execute("""UPDATE group_chats SET invite_code = invite_code || '-' || id
+                    WHERE id NOT IN (SELECT MIN(id) FROM group_chats GROUP BY invite_code)""")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_group_chats_invite_code ON group_chats(invite_code)")
+
+
+# 4. user_group_chats 改为 (user_id, group_chat_id) 复合主键，去掉重复的成员关系
+def _user_group_chats_primary_key(conn):
+    conn.execute('''CREATE TABLE user_group_chats_new
+                    (user_id TEXT NOT NULL,
+                     group_chat_id INTEGER NOT NULL,
+                     PRIMARY KEY(user_id, group_chat_id),
+                     FOREIGN KEY(user_id) REFERENCES users(username),
+                     FOREIGN KEY(group_chat_id) REFERENCES group_chats(id)) WITHOUT ROWID''')
+    conn.execute("INSERT OR IGNORE INTO user_group_chats_new (user_id, group_chat_id) "
+                 "SELECT user_id, group_chat_id FROM user_group_chats")
+    conn.execute("DROP TABLE user_group_chats")
+    conn.execute("ALTER TABLE user_group_chats_new RENAME TO user_group_chats")
+
+
+# 5. 热点查询的复合索引
+def _hot_path_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_conversation "
+                 "ON messages(conversation_id, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_user "
+                 "ON conversations(user_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_group_messages_group "
+                 "ON group_messages(group_id, timestamp)")
+
+
+# 6. 群聊消息按自增ID增量同步的游标索引
+def _group_message_cursor_index(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_group_messages_cursor "
+                 "ON group_messages(group_id, id)")
+
+
+# 7. 断线重连时按客户端最后收到的 msg_id 定位补发起点
+def _group_message_msg_id_index(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_group_messages_msg_id ON group_messages(msg_id)")
+
+
+# 8. 对话消息按ID分页加载
+def _message_page_index(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON messages(conversation_id, id)")
+
+
+# 9. 单人对话与群聊消息的全文检索：无内容 FTS5 表只存索引，由触发器同步，
+#    fts_tokens 为 db 连接注册的 Python 函数（见 fulltext.py）
+def _fts_tables(conn):
+    for table, fts in (("messages", "messages_fts"), ("group_messages", "group_messages_fts")):
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+                     f"tokens, content='', tokenize='unicode61 remove_diacritics 0')")
+        conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN
+                             INSERT INTO {fts}(rowid, tokens) VALUES (new.id, fts_tokens(new.content));
+                         END""")
+        conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN
+                             INSERT INTO {fts}({fts}, rowid, tokens) VALUES ('delete', old.id, fts_tokens(old.content));
+                         END""")
+        conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF content ON {table} BEGIN
+                             INSERT INTO {fts}({fts}, rowid, tokens) VALUES ('delete', old.id, fts_tokens(old.content));
+                             INSERT INTO {fts}(rowid, tokens) VALUES (new.id, fts_tokens(new.content));
+                         END""")
+        conn.execute(f"INSERT INTO {fts}(rowid, tokens) SELECT id, fts_tokens(content) FROM {table}")
+
+
+# 10. 冷数据归档：长期不活跃的对话消息压缩后按块存放，打开对话时恢复（见 archive.py）
+def _message_archive(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS message_archive
+                    (conversation_id INTEGER NOT NULL,
+                     chunk INTEGER NOT NULL,
+                     message_count INTEGER NOT NULL,
+                     data BLOB NOT NULL,
+                     archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                     PRIMARY KEY(conversation_id, chunk),
+                     FOREIGN KEY(conversation_id) REFERENCES conversations(id))''')
+
+
+# 11. 归档的消息仍可检索，恢复的对话不会被立即再次归档：
+#     archived_messages 记录每条归档消息所在的块，messages_fts 的插入/删除触发器跳过其中的消息，
+#     归档和恢复时全文索引保持不变；conversations.last_active_at 记录最近一次恢复（打开）的时间
+def _archive_search_and_activity(conn):
+    if "last_active_at" not in _columns(conn, "conversations"):
+        conn.execute("ALTER TABLE conversations ADD COLUMN last_active_at TIMESTAMP")
+    conn.execute('''CREATE TABLE IF NOT EXISTS archived_messages
+                    (id INTEGER PRIMARY KEY,
+                     conversation_id INTEGER NOT NULL,
+                     chunk INTEGER NOT NULL)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archived_messages_conversation "
+                 "ON archived_messages(conversation_id)")
+    conn.execute("DROP TRIGGER IF EXISTS messages_fts_insert")
+    conn.execute("DROP TRIGGER IF EXISTS messages_fts_delete")
+    conn.execute("""CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages
+                    WHEN NOT EXISTS (SELECT 1 FROM archived_messages WHERE id = new.id) BEGIN
+                        INSERT INTO messages_fts(rowid, tokens) VALUES (new.id, fts_tokens(new.content));
+                    END""")
+    conn.execute("""CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages
+                    WHEN NOT EXISTS (SELECT 1 FROM archived_messages WHERE id = old.id) BEGIN
+                        INSERT INTO messages_fts(messages_fts, rowid, tokens)
+                        VALUES ('delete', old.id, fts_tokens(old.content));
+                    END""")
+    # 此前已归档的消息：补上块位置，并重新建立它们被删除的全文索引
+    decompressor = zstandard.ZstdDecompressor()
+    for conversation_id, chunk, data in conn.execute(
+            "SELECT conversation_id, chunk, data FROM message_archive").fetchall():
+        for message_id, _, content, _ in json.loads(decompressor.decompress(data)):
+            conn.execute("INSERT OR IGNORE INTO archived_messages (id, conversation_id, chunk) VALUES (?, ?, ?)",
+                         (message_id, conversation_id, chunk))
+            conn.execute("INSERT INTO messages_fts(rowid, tokens) VALUES (?, fts_tokens(?))",
+                         (message_id, content))
+
+
+MIGRATIONS = [
+    _create_base_tables,
+    _add_group_message_msg_id,
+    _unique_invite_code,
+    _user_group_chats_primary_key,
+    _hot_path_indexes,
+    _group_message_cursor_index,
+    _group_message_msg_id_index,
+    _message_page_index,
+    _fts_tables,
+    _message_archive,
+    _archive_search_and_activity,
+]
+
+
+# 在调用方开启的写事务中执行，返回执行后的版本号
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        migration(conn)
+        conn.execute(f"PRAGMA user_version = {number}")
+    return max(version, len(MIGRATIONS))
@@ -1,91 +1,25 @@
 import streamlit as st
 import requests
-import json
-import sqlite3
-from datetime import datetime
-import os
-import random
-import string
-import time
-import websockets
-import asyncio
-from streamlit.runtime.scriptrunner import add_script_run_ctx
-import uuid
-
-# WebSocket消息监听
-def start_websocket_listener():
-    async def listen_messages():
-        group_id = str(st.session_state.current_group["id"])
-        uri = f"ws://127.0.0.1:6006/ws/{group_id}"
-
-        while True:
-            try:
-                async with websockets.connect(uri) as websocket:
-                    while True:
-                        message = await websocket.recv()
-                        msg_data = json.loads(message)
-
-                        # 消息去重校验
-                        existing_ids = [msg.get("msg_id") for msg in st.session_state.history if msg.get("msg_id")]
-                        if msg_data.get("msg_id") in existing_ids:
-                            continue
-
-                        # 更新历史并刷新
-                        st.session_state.history.append({
-                            "msg_id": msg_data["msg_id"],
-                            "role": "user",
-                            "content": f"{msg_data['username']}: {msg_data['content']}"
-                        })
-                        st.rerun()
-            except Exception as e:
-                print(f"连接错误: {e}")
-                await asyncio.sleep(3)
-
-    # 创建新事件循环并绑定到当前线程
-    if "ws_task" not in st.session_state:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        st.session_state.ws_task = loop.create_task(listen_messages())
-        # 绑定任务到Streamlit上下文
-        add_script_run_ctx(st.session_state.ws_task)
-
-# 在页面初始化时启动监听
-if "ws_started" not in st.session_state:
-    start_websocket_listener()
-    st.session_state.ws_started = True
-
-# 修改消息发送逻辑
-async def send_websocket_message(content):
-    group_id = str(st.session_state.current_group["id"])
-    message = json.dumps({
-        "msg_id": str(uuid.uuid4()),
-        "username": st.session_state.username,
-        "content": content,
-        "group_id": group_id,
-        "user_id": st.session_state.username
-    })
-    uri = f"ws://127.0.0.1:6006/ws/{group_id}"
-
-    # 添加重试机制
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            async with websockets.connect(uri) as websocket:
-                message = json.dumps({
-                    "msg_id": str(uuid.uuid4()),  # 添加唯一消息ID
-                    "type": "message",
-                    "username": st.session_state.username,
-                    "content": content,
-                    "group_id": group_id,
-                    "timestamp": datetime.now().isoformat()
-                })
-                await websocket.send(message)
-                return True
-        except Exception as e:
-            if attempt == max_retries - 1:
-                st.error(f"消息发送失败: {str(e)}")
-                return False
-            await asyncio.sleep(0.5)
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from dataclasses import asdict
+import db
+import auth
+import profile_cache
+import avatars
+import group_client
+from config import BOT_USER_ID
+
+# 浏览器仍连接着的会话；Streamlit 没有公开的会话结束回调，这里依赖 1.31 的内部接口 Runtime._session_mgr
+def active_session(session_id):
+    return Runtime.instance()._session_mgr.get_active_session_info(session_id)
+
+
+# 在接收线程中请求重跑指定会话的页面；会话已结束时忽略（连接随后由 is_wanted 检查自行关闭）
+def request_rerun(session_id):
+    session_info = active_session(session_id)
+    if session_info is not None:
+        session_info.session.request_rerun(None)
 
 # 页面配置
 st.set_page_config(
@@ -106,74 +40,15 @@ st.markdown("""
 st.title("📚 智能数学学习平台")
 st.caption("基于本地数学知识库的智能问答系统")
 
-# 在显示右侧边栏内容部分添加
-def get_user_info(username):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT nickname, role, avatar_path FROM users WHERE username = ?", (username,))
-    result = c.fetchone()
-    conn.close()
-    return {
-        "nickname": result[0],
-        "role": result[1],
-        "avatar": result[2]
-    } if result else None
-
-# 数据库初始化函数（添加调用）
-def init_chat_db():
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-
-    # 群聊表
-    c.execute('''CREATE TABLE IF NOT EXISTS group_chats
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      title TEXT NOT NULL,
-                      invite_code TEXT NOT NULL UNIQUE,
-                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-    # 新增群聊消息表
-    c.execute('''CREATE TABLE IF NOT EXISTS group_messages
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      group_id INTEGER NOT NULL,
-                      user_id TEXT NOT NULL,
-                      content TEXT NOT NULL,
-                      timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                      FOREIGN KEY(group_id) REFERENCES group_chats(id))''')
-
-    conn.commit()
-    conn.close()
-
-
-# 初始化数据库（新增调用）
-init_chat_db()
-
-# 在创建群聊时生成唯一邀请码
-def generate_unique_invite_code():
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    while True:
-        invite_code = ''.join(random.choices(
-            string.ascii_uppercase + string.digits, k=6
-        ))
-        c.execute("SELECT id FROM group_chats WHERE invite_code = ?", (invite_code,))
-        if not c.fetchone():
-            conn.close()
-            return invite_code
-
-
 # 初始化群聊状态（添加路径检查）
-if "current_group" not in st.session_state:
-    st.switch_page("app.py")  # 跳回首页如果直接访问
+if ("current_group" not in st.session_state
+        or auth.verify_token(st.session_state.get("session_token")) != st.session_state.get("username")):
+    st.switch_page("app.py")  # 跳回首页如果直接访问或会话令牌失效
 else:
     # 验证群聊ID有效性
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT id FROM group_chats WHERE id = ?",
-              (st.session_state.current_group["id"],))
-    if not c.fetchone():
+    if profile_cache.get_group_chat(st.session_state.current_group["id"]) is None:
         del st.session_state.current_group
         st.switch_page("pages/single_chat.py")
-    conn.close()
 
 # 添加群聊ID变化检测
 if "last_group_id" not in st.session_state:
@@ -184,37 +59,79 @@ if st.session_state.last_group_id != st.session_state.current_group["id"]:
     for key in list(st.session_state.keys()):
         if key.startswith("history_loaded_"):
             del st.session_state[key]
+    # 关闭旧群聊的连接
+    if "group_connection" in st.session_state:
+        st.session_state.pop("group_connection").stop()
     st.session_state.last_group_id = st.session_state.current_group["id"]
 
 # 加载群聊历史记录（使用群聊ID标识状态）
 current_group_id = st.session_state.current_group["id"]
 history_key = f"history_loaded_{current_group_id}"
 
-if "last_refresh" not in st.session_state:
-    st.session_state.last_refresh = time.time()
-
-# 自动刷新逻辑
-if time.time() - st.session_state.last_refresh > 2:  # 每2秒刷新一次
-    st.session_state[history_key] = False
-    st.session_state.last_refresh = time.time()
-    st.rerun()
+# 每个会话一条后台长连接，有新消息时才触发重跑，空闲的群聊页面不再轮询
+# 标签页关闭后连接自行关闭；会话恢复（浏览器重连）时重新建立
+if "group_connection" not in st.session_state or st.session_state.group_connection.closed:
+    session_id = get_script_run_ctx().session_id
+    connection = group_client.GroupConnection(current_group_id,
+                                              lambda: request_rerun(session_id),
+                                              lambda: active_session(session_id) is not None,
+                                              st.session_state.session_token)
+    connection.start()
+    st.session_state.group_connection = connection
+
+
+def append_history(msg_id, user_id, content):
+    # 同一条消息可能既从数据库同步到、又经 WebSocket 推送到，按 msg_id 去重
+    if msg_id is not None:
+        if msg_id in st.session_state.seen_msg_ids:
+            return
+        st.session_state.seen_msg_ids.add(msg_id)
+    # 机器人回答的完整消息到达后不再显示它的流式片段
+    st.session_state.bot_streams.pop(msg_id, None)
+    # 机器人的回答以助手身份显示，与流式片段一致
+    if user_id == BOT_USER_ID:
+        role, content = "assistant", f"助手: {content}"
+    else:
+        role, content = "user", f"{user_id}: {content}"
+    st.session_state.history.append({
+        "msg_id": msg_id,  # 添加msg_id
+        "role": role,
+        "content": content
+    })
 
-conn = sqlite3.connect('users.db')
-c = conn.cursor()
-c.execute("""SELECT user_id, content, msg_id FROM group_messages 
-           WHERE group_id = ? ORDER BY timestamp""",
-          (current_group_id,))
-messages = c.fetchall()
-conn.close()
 
-# 直接更新历史记录，不依赖缓存
-st.session_state.history = [
-    {
-        "msg_id": msg_id,  # 添加msg_id
-        "role": "user",
-        "content": f"{user}: {msg}"
-    } for user, msg, msg_id in messages  # 解构三元组
-]
+# 切换群聊或手动刷新时从头加载，否则从上次的游标开始只取新消息
+if not st.session_state.get(history_key):
+    st.session_state.history = []
+    st.session_state.seen_msg_ids = set()
+    # 正在生成的机器人回答：stream_id -> 已收到的内容
+    st.session_state.bot_streams = {}
+    st.session_state.group_cursor = 0
+    st.session_state[history_key] = True
+
+try:
+    new_messages, st.session_state.group_cursor = group_client.sync_group_messages(
+        current_group_id, st.session_state.group_cursor, st.session_state.session_token)
+except requests.exceptions.RequestException:
+    # 服务端不可用时直接读库
+    rows = db.list_group_messages_after(current_group_id, st.session_state.group_cursor,
+                                        group_client.SYNC_PAGE_SIZE)
+    new_messages = [asdict(row) for row in rows]
+    if rows:
+        st.session_state.group_cursor = rows[-1].id
+
+for msg in new_messages:
+    append_history(msg["msg_id"], msg["user_id"], msg["content"])
+# 已推送但可能尚未写入数据库的消息
+for frame in st.session_state.group_connection.drain():
+    frame_type = frame.get("type", "message")
+    if frame_type == "bot_chunk":
+        streams = st.session_state.bot_streams
+        streams[frame["stream_id"]] = streams.get(frame["stream_id"], "") + frame["content"]
+    elif frame_type == "notice":
+        st.toast(frame["content"])
+    elif frame_type == "message":
+        append_history(frame.get("msg_id"), frame.get("user_id") or frame.get("username"), frame["content"])
 
 # 侧边栏信息显示（保持不变）
 with st.sidebar:
@@ -270,15 +187,14 @@ with st.sidebar:
     </style>
     """, unsafe_allow_html=True)
 
-    user_info = get_user_info(st.session_state.username)
+    user_info = profile_cache.get_user(st.session_state.username)
     if user_info:
-        avatar_path = os.path.join(os.getcwd(), user_info['avatar'])
         st.markdown(f"""
         <div class="user-card">
-            <img src="{avatar_path}" class="avatar">
+            <img src="{avatars.avatar_url(user_info.avatar_path)}" class="avatar">
             <div class="user-info">
-                <h3 style="margin:0;font-size:18px">{user_info['nickname']}</h3>
-                <p style="margin:0;color:#666">{user_info['role']}</p>
+                <h3 style="margin:0;font-size:18px">{user_info.nickname}</h3>
+                <p style="margin:0;color:#666">{user_info.role}</p>
             </div>
         </div>
         """, unsafe_allow_html=True)
@@ -288,14 +204,11 @@ with st.sidebar:
 
     # 退出群聊按钮
     if st.button("退出群聊"):
-        if "ws_task" in st.session_state:
-            st.session_state.ws_task.cancel()
-            try:
-                asyncio.get_event_loop().run_until_complete(st.session_state.ws_task)
-            except asyncio.CancelledError:
-                pass
+        if "group_connection" in st.session_state:
+            st.session_state.group_connection.stop()
         # 清除所有群聊相关状态
-        keys_to_remove = ["current_group", "last_group_id", "ws_task", "ws_started"]
+        keys_to_remove = ["current_group", "last_group_id", "group_connection", "group_cursor", "seen_msg_ids",
+                          "bot_streams"]
         for key in keys_to_remove:
             if key in st.session_state:
                 del st.session_state[key]
@@ -312,90 +225,24 @@ if st.button("🔄 刷新消息"):
 # 消息展示区域
 with st.container():
     for msg in st.session_state.history:
-        # 使用精确前缀判断
-        role = "assistant" if msg["content"].startswith("助手:") else "user"
-        st.chat_message(role).write(msg["content"])
+        st.chat_message(msg["role"]).write(msg["content"])
+    # 服务端正在流式生成的机器人回答
+    for partial in st.session_state.bot_streams.values():
+        st.chat_message("assistant").write(f"助手: {partial}▌")
 
 # 用户输入处理
 if prompt := st.chat_input("请输入您的问题..."):
     try:
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute("BEGIN TRANSACTION")
-
-        # 获取 group_id 和 username
-        group_id = st.session_state.current_group["id"]
         username = st.session_state.username
 
-        # 插入用户消息（始终保存）
-        msg_id = str(uuid.uuid4())
-        c.execute("""INSERT INTO group_messages 
-                   (group_id, user_id, content, msg_id)
-                   VALUES (?, ?, ?, ?)""",
-                  (group_id, username, prompt, msg_id))
-
-        # 检查是否包含特定指令
-        if "@数学帮帮" in prompt:  # 修改判断条件
-            # 提取有效问题内容（去除指令关键词）
-            query = prompt.replace("@数学帮帮", "").strip()  # 移除关键词
-
-            # 构造AI请求
-            payload = {
-                "query": query,  # 使用处理后的查询内容
-                "knowledge_base_name": "math",
-                "top_k": 3,
-                "score_threshold": 0.85,
-                "history": [msg for msg in st.session_state.history if msg["role"] == "user"],
-                "stream": True,
-                "model_name": "chatglm3-6b",
-                "temperature": 0.3
-            }
-
-            # 处理AI响应
-            full_answer = ""
-            try:
-                with requests.post(
-                        "http://127.0.0.1:6006/chat/knowledge_base_chat",
-                        json=payload, stream=True, timeout=30) as response:
-                    if response.status_code == 200:
-                        for line in response.iter_lines():
-                            if line and line.startswith(b'data: '):
-                                data = json.loads(line.decode('utf-8')[6:])
-                                full_answer += data.get("answer", "")
-            except requests.exceptions.Timeout:
-                full_answer = "请求超时，请稍后再试"
-            except Exception as e:
-                full_answer = f"请求异常：{str(e)}"
-                raise
-
-            # 保存AI回复到数据库
-            c.execute("""INSERT INTO group_messages (group_id, user_id, content)
-                    VALUES (?, ?, ?)""",
-                      (st.session_state.current_group["id"],
-                       "assistant",
-                       full_answer))
-
-            # 更新会话历史
-            st.session_state.history.extend([
-                {"role": "user", "content": f"{st.session_state.username}: {prompt}"},
-                {"role": "assistant", "content": f"助手: {full_answer}"}
-            ])
-
-        else:
-            # 仅更新用户消息历史
-            st.session_state.history.append(
-                {"role": "user", "content": f"{st.session_state.username}: {prompt}"}
-            )
-
-        conn.commit()
+        # 经长连接发送，服务端写入数据库并广播后回复确认
+        _, acked = st.session_state.group_connection.send(username, prompt)
+        if acked.result(timeout=group_client.ACK_TIMEOUT) != "ok":
+            raise RuntimeError("消息保存失败")
 
-        # 新增WebSocket推送
-        asyncio.run(send_websocket_message(prompt))
+        # @数学帮帮 的提问由服务端排队回答，回答会流式推送给整个群聊
+        # 会话历史不在这里追加，重跑页面时由推送和增量同步取回刚写入的消息，避免重复显示
 
     except Exception as e:
-        conn.rollback()
         st.error(f"操作失败: {str(e)}")
-    finally:
-        if conn:
-            conn.close()
     st.rerun()
\ No newline at end of file
@@ -3,97 +3,37 @@ import requests
 import json
 import sqlite3
 from datetime import datetime
-import random
-import string
-import os
-
-def get_user_info(username):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT nickname, role, avatar_path FROM users WHERE username = ?", (username,))
-    result = c.fetchone()
-    conn.close()
-    return {
-        "nickname": result[0],
-        "role": result[1],
-        "avatar": result[2]
-    } if result else None
-
-
-
-def generate_unique_invite_code():
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    while True:
-        invite_code = ''.join(random.choices(
-            string.ascii_uppercase + string.digits, k=6
-        ))
-        c.execute("SELECT id FROM group_chats WHERE invite_code = ?", (invite_code,))
-        if not c.fetchone():
-            conn.close()
-            return invite_code
-
-# 数据库初始化函数
-def init_chat_db():
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-
-    # 创建对话表
-    c.execute('''CREATE TABLE IF NOT EXISTS conversations
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id TEXT NOT NULL,
-                  title TEXT NOT NULL,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY(user_id) REFERENCES users(username))''')
-
-    # 创建消息表
-    c.execute('''CREATE TABLE IF NOT EXISTS messages
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  conversation_id INTEGER NOT NULL,
-                  role TEXT NOT NULL,
-                  content TEXT NOT NULL,
-                  timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY(conversation_id) REFERENCES conversations(id))''')
-
-    # 创建群聊表
-    c.execute('''CREATE TABLE IF NOT EXISTS group_chats
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      title TEXT NOT NULL,
-                      invite_code TEXT NOT NULL,
-                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-
-    # 创建用户群聊关联表
-    c.execute('''CREATE TABLE IF NOT EXISTS user_group_chats
-                     (user_id TEXT NOT NULL,
-                      group_chat_id INTEGER NOT NULL,
-                      FOREIGN KEY(user_id) REFERENCES users(username),
-                      FOREIGN KEY(group_chat_id) REFERENCES group_chats(id))''')
-
-
-    conn.commit()
-    conn.close()
-
-# 初始化数据库
-init_chat_db()
-
-
-# 确保用户已登录且会话状态正确初始化
-if "username" not in st.session_state or not st.session_state.get("authenticated", False):
+import db
+import auth
+import profile_cache
+import avatars
+import context_builder
+
+# 确保用户已登录且会话状态正确初始化；会话令牌只校验签名和有效期，不查数据库
+if ("username" not in st.session_state or not st.session_state.get("authenticated", False)
+        or auth.verify_token(st.session_state.get("session_token")) != st.session_state.username):
     st.switch_page("app.py")  # 强制跳转回登录页面
 
+# 对话消息每页条数
+MESSAGE_PAGE_SIZE = 30
+# 侧边栏对话列表每页条数
+CONVERSATION_PAGE_SIZE = 20
+# 历史消息检索每页条数
+SEARCH_PAGE_SIZE = 10
+
+
+# 加载 before_id 之前的一页消息，返回 (消息列表, 更早一页的游标)；没有更早的消息时游标为None
+def load_message_page(conv_id, before_id=None):
+    rows = db.list_messages_before(conv_id, before_id, MESSAGE_PAGE_SIZE + 1)
+    has_earlier = len(rows) > MESSAGE_PAGE_SIZE
+    rows = rows[-MESSAGE_PAGE_SIZE:]
+    return [{"role": m.role, "content": m.content} for m in rows], (rows[0].id if has_earlier else None)
+
+
 # 确保username属性存在
 if "username" not in st.session_state:
     st.session_state.username = None  # 初始化默认值
 
-# 获取用户昵称
-def get_user_nickname(username):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT nickname FROM users WHERE username = ?", (username,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else None
-
 # 初始化页面配置
 st.set_page_config(
     page_title="智能数学学习平台",
@@ -163,13 +103,9 @@ with st.sidebar:
         # 新建对话按钮
         if st.button("+ 新建对话"):
             # 创建新对话记录
-            conn = sqlite3.connect('users.db')
-            c = conn.cursor()
-            c.execute("INSERT INTO conversations (user_id, title) VALUES (?, ?)",
-                      (st.session_state.username, f"对话-{datetime.now().strftime('%m-%d %H:%M')}"))
-            new_conv_id = c.lastrowid
-            conn.commit()
-            conn.close()
+            new_conv_id = db.create_conversation(st.session_state.username,
+                                                 f"对话-{datetime.now().strftime('%m-%d %H:%M')}")
+            profile_cache.invalidate_conversations(st.session_state.username)
 
             # 重置当前会话
             st.session_state.current_conv = new_conv_id
@@ -179,18 +115,10 @@ with st.sidebar:
         # 新增删除当前对话按钮
         if st.button("删除当前对话"):
             if "current_conv" in st.session_state:
-                # 删除数据库记录
-                conn = sqlite3.connect('users.db')
-                c = conn.cursor()
-
+                # 删除数据库记录（消息与对话在同一事务中删除）
                 try:
-                    # 先删除关联消息
-                    c.execute("DELETE FROM messages WHERE conversation_id = ?",
-                              (st.session_state.current_conv,))
-                    # 再删除对话
-                    c.execute("DELETE FROM conversations WHERE id = ?",
-                              (st.session_state.current_conv,))
-                    conn.commit()
+                    db.delete_conversation(st.session_state.current_conv)
+                    profile_cache.invalidate_conversations(st.session_state.username)
 
                     # 清除会话状态（但不创建新对话）
                     del st.session_state.current_conv
@@ -198,10 +126,7 @@ with st.sidebar:
                     st.success("对话已删除")
 
                 except sqlite3.Error as e:
-                    conn.rollback()
                     st.error(f"删除失败: {str(e)}")
-                finally:
-                    conn.close()
 
                 st.rerun()
 
@@ -234,6 +159,35 @@ with st.sidebar:
                 </style>
             """, unsafe_allow_html=True)
 
+        # 全文检索历史消息
+        with st.expander("🔍 搜索历史消息"):
+            search_query = st.text_input("关键词（支持中文和LaTeX命令）", key="message_search").strip()
+            search_scope = st.radio("范围", ["我的对话", "我的群聊"], horizontal=True, key="message_search_scope")
+            if (search_query, search_scope) != st.session_state.get("message_search_last"):
+                st.session_state.message_search_last = (search_query, search_scope)
+                st.session_state.message_search_page = 0
+            if search_query:
+                search_fn = db.search_messages if search_scope == "我的对话" else db.search_group_messages
+                offset = st.session_state.message_search_page * SEARCH_PAGE_SIZE
+                hits = search_fn(st.session_state.username, search_query, SEARCH_PAGE_SIZE + 1, offset)
+                if not hits:
+                    st.caption("没有找到相关消息")
+                for hit in hits[:SEARCH_PAGE_SIZE]:
+                    st.markdown(f"{hit.author}（{hit.timestamp}）：{hit.snippet}")
+                    if search_scope == "我的对话" and st.button("打开对话", key=f"search_hit_{hit.id}"):
+                        messages, before_id = load_message_page(hit.parent_id)
+                        st.session_state.current_conv = hit.parent_id
+                        st.session_state.history = messages
+                        st.session_state.earlier_cursor = (hit.parent_id, before_id)
+                        st.rerun()
+                col_prev, col_next = st.columns(2)
+                if st.session_state.message_search_page > 0 and col_prev.button("上一页", key="search_prev"):
+                    st.session_state.message_search_page -= 1
+                    st.rerun()
+                if len(hits) > SEARCH_PAGE_SIZE and col_next.button("下一页", key="search_next"):
+                    st.session_state.message_search_page += 1
+                    st.rerun()
+
         # 原始左侧边栏内容
         st.header("历史对话记录")
 
@@ -245,31 +199,38 @@ with st.sidebar:
             history_list = st.container()
 
             with history_list:
-                # 获取当前用户的对话历史
-                conn = sqlite3.connect('users.db')
-                c = conn.cursor()
-                c.execute("SELECT id, title FROM conversations WHERE user_id = ? ORDER BY created_at DESC",
-                          (st.session_state.username,))
-                conversations = c.fetchall()
-                conn.close()
+                # 按标题搜索；搜索词变化时回到第一页
+                title_query = st.text_input("搜索对话标题", key="conv_search").strip() or None
+                if st.session_state.get("conv_search_query") != title_query:
+                    st.session_state.conv_search_query = title_query
+                    st.session_state.conv_pages_shown = 1
+
+                # 逐页获取当前用户的对话历史（每页都有缓存），只渲染已展开的页
+                conversations, cursor = [], None
+                for _ in range(st.session_state.get("conv_pages_shown", 1)):
+                    page, cursor = profile_cache.list_conversations_page(
+                        st.session_state.username, cursor, CONVERSATION_PAGE_SIZE, title_query)
+                    conversations.extend(page)
+                    if cursor is None:
+                        break
 
                 # 显示对话历史
                 for conv in conversations:
-                    conv_id, title = conv
+                    conv_id, title = conv.id, conv.title
                     # 为每个对话创建点击区域
                     if st.button(title, key=f"conv_{conv_id}"):
-                        # 加载选中对话的历史记录
-                        conn = sqlite3.connect('users.db')
-                        c = conn.cursor()
-                        c.execute("SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY timestamp",
-                                  (conv_id,))
-                        messages = [{"role": role, "content": content} for role, content in c.fetchall()]
-                        conn.close()
+                        # 只加载选中对话最近的一页消息，更早的消息按需加载
+                        messages, before_id = load_message_page(conv_id)
 
                         st.session_state.current_conv = conv_id
                         st.session_state.history = messages
+                        st.session_state.earlier_cursor = (conv_id, before_id)
                         st.rerun()
 
+                if cursor is not None and st.button("加载更多对话"):
+                    st.session_state.conv_pages_shown = st.session_state.get("conv_pages_shown", 1) + 1
+                    st.rerun()
+
             st.markdown('</div>', unsafe_allow_html=True)
 
         # 修改后的按钮布局
@@ -279,6 +240,7 @@ with st.sidebar:
             if st.button("退出登录", key="logout_left"):
                 st.session_state.authenticated = False
                 st.session_state.username = None
+                st.session_state.pop("session_token", None)
                 st.switch_page("app.py")
         with col2:
             if st.button("切换侧边栏", key="toggle_left"):
@@ -313,15 +275,14 @@ with st.sidebar:
         </style>
         """, unsafe_allow_html=True)
 
-        user_info = get_user_info(st.session_state.username)
+        user_info = profile_cache.get_user(st.session_state.username)
         if user_info:
-            avatar_path = os.path.join(os.getcwd(), user_info['avatar'])
             st.markdown(f"""
             <div class="user-card">
-                <img src="{avatar_path}" class="avatar">
+                <img src="{avatars.avatar_url(user_info.avatar_path)}" class="avatar">
                 <div class="user-info">
-                    <h3 style="margin:0;font-size:18px">{user_info['nickname']}</h3>
-                    <p style="margin:0;color:#666">{user_info['role']}</p>
+                    <h3 style="margin:0;font-size:18px">{user_info.nickname}</h3>
+                    <p style="margin:0;color:#666">{user_info.role}</p>
                 </div>
             </div>
             """, unsafe_allow_html=True)
@@ -362,17 +323,12 @@ with st.sidebar:
                         st.error("群聊名称不能超过20个字符")
                     else:
                         # 生成唯一邀请码
-                        invite_code = generate_unique_invite_code()
+                        invite_code = db.generate_unique_invite_code()
 
-                        conn = sqlite3.connect('users.db')
-                        c = conn.cursor()
                         try:
-                            c.execute("INSERT INTO group_chats (title, invite_code) VALUES (?, ?)",
-                                      (group_name, invite_code))
-                            group_chat_id = c.lastrowid
-                            c.execute("INSERT INTO user_group_chats (user_id, group_chat_id) VALUES (?, ?)",
-                                      (st.session_state.username, group_chat_id))
-                            conn.commit()
+                            group_chat_id = db.create_group_chat(group_name, invite_code,
+                                                                 st.session_state.username)
+                            profile_cache.invalidate_user_groups(st.session_state.username)
 
                             # 更新会话状态
                             st.session_state.current_group = {
@@ -390,81 +346,50 @@ with st.sidebar:
                             st.switch_page("pages/group_chat.py")
 
                         except sqlite3.Error as e:
-                            conn.rollback()
                             st.error(f"创建失败: {str(e)}")
-                        finally:
-                            conn.close()
 
 
 
         # 获取群聊列表数据
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute("SELECT group_chats.id, group_chats.title FROM group_chats "
-                    "JOIN user_group_chats ON group_chats.id = user_group_chats.group_chat_id "
-                    "WHERE user_group_chats.user_id = ?", (st.session_state.username,))
-        group_chats = c.fetchall()
-        conn.close()
+        group_chats = profile_cache.list_user_group_chats(st.session_state.username)
 
         st.header("群聊列表")
-        # 显示群聊列表（修改后的代码）
+        # 显示群聊列表（列表查询已包含完整的群聊信息）
         for group_chat in group_chats:
-            group_chat_id, group_title = group_chat
-            if st.button(group_title, key=f"group_side_{group_chat_id}"):
-                # 获取完整的群聊信息
-                conn = sqlite3.connect('users.db')
-                c = conn.cursor()
-                c.execute("SELECT title, invite_code FROM group_chats WHERE id = ?", (group_chat_id,))
-                group_info = c.fetchone()
-                conn.close()
-
-                if group_info:
-                    # 保存到会话状态
-                    st.session_state.current_group = {
-                        "id": group_chat_id,
-                        "name": group_info[0],
-                        "invite_code": group_info[1]
-                    }
-                    # 跳转到群聊页面
-                    st.switch_page("pages/group_chat.py")
+            if st.button(group_chat.title, key=f"group_side_{group_chat.id}"):
+                # 保存到会话状态
+                st.session_state.current_group = {
+                    "id": group_chat.id,
+                    "name": group_chat.title,
+                    "invite_code": group_chat.invite_code
+                }
+                # 跳转到群聊页面
+                st.switch_page("pages/group_chat.py")
 
         # 输入邀请码加入群聊
         invite_code = st.text_input("输入邀请码加入群聊")
         if st.button("加入群聊"):
-            conn = sqlite3.connect('users.db')
-            c = conn.cursor()
             try:
-                c.execute("SELECT id FROM group_chats WHERE invite_code = ?", (invite_code,))
-                result = c.fetchone()
-                if result:
-                    group_chat_id = result[0]
+                group_chat = db.get_group_chat_by_invite_code(invite_code)
+                if group_chat:
                     # 检查是否已加入
-                    c.execute("SELECT 1 FROM user_group_chats WHERE user_id = ? AND group_chat_id = ?",
-                              (st.session_state.username, group_chat_id))
-                    if not c.fetchone():
-                        c.execute("INSERT INTO user_group_chats (user_id, group_chat_id) VALUES (?, ?)",
-                                  (st.session_state.username, group_chat_id))
-                        conn.commit()
+                    if db.join_group_chat(st.session_state.username, group_chat.id):
+                        profile_cache.invalidate_user_groups(st.session_state.username)
                         st.success("成功加入群聊")
                     else:
                         st.warning("您已在群聊中")
 
                     # 更新群聊状态
-                    c.execute("SELECT title, invite_code FROM group_chats WHERE id = ?", (group_chat_id,))
-                    group_info = c.fetchone()
-
                     st.session_state.current_group = {
-                        "id": group_chat_id,
-                        "name": group_info[0],
-                        "invite_code": group_info[1]
+                        "id": group_chat.id,
+                        "name": group_chat.title,
+                        "invite_code": group_chat.invite_code
                     }
                     st.rerun()
                 else:
                     st.error("邀请码无效")
             except sqlite3.IntegrityError:
                 st.error("操作失败：邀请码已失效")
-            finally:
-                conn.close()
 
         # 修改后的按钮布局
         st.markdown("---")
@@ -473,6 +398,7 @@ with st.sidebar:
             if st.button("退出登录", key="logout_right"):
                 st.session_state.authenticated = False
                 st.session_state.username = None
+                st.session_state.pop("session_token", None)
                 st.switch_page("app.py")
         with col2:
             if st.button("切换侧边栏", key="toggle_right"):
@@ -496,6 +422,14 @@ st.markdown("""
 # 对话展示区域
 with st.container():
     if "current_conv" in st.session_state:  # 新增判断
+        # 游标与对话ID一起保存，切换或新建对话后旧游标自动失效
+        earlier_conv, before_id = st.session_state.get("earlier_cursor", (None, None))
+        if earlier_conv == st.session_state.current_conv and before_id is not None:
+            if st.button("加载更早的消息"):
+                older, before_id = load_message_page(earlier_conv, before_id)
+                st.session_state.history = older + st.session_state.history
+                st.session_state.earlier_cursor = (earlier_conv, before_id)
+                st.rerun()
         for msg in st.session_state.history:
             if msg["role"] == "user":
                 st.chat_message("user").write(msg["content"])
@@ -511,21 +445,12 @@ if prompt := st.chat_input("请输入您的问题..."):
     # 确保当前对话存在（新增逻辑）
     if "current_conv" not in st.session_state:
         # 创建新对话（仅在首次提问时）
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute("BEGIN TRANSACTION")  # 开启事务
-
         try:
-            # 创建对话记录
-            c.execute("INSERT INTO conversations (user_id, title) VALUES (?, ?)",
-                      (st.session_state.username, f"对话-{datetime.now().strftime('%m-%d %H:%M')}"))
-            new_conv_id = c.lastrowid
-
-            # 插入用户消息
-            c.execute("INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
-                      (new_conv_id, "user", prompt))
-
-            conn.commit()
+            # 创建对话记录并插入用户消息（同一事务）
+            new_conv_id = db.create_conversation(st.session_state.username,
+                                                 f"对话-{datetime.now().strftime('%m-%d %H:%M')}",
+                                                 first_message=prompt)
+            profile_cache.invalidate_conversations(st.session_state.username)
 
             # 更新会话状态
             st.session_state.current_conv = new_conv_id
@@ -576,31 +501,19 @@ if prompt := st.chat_input("请输入您的问题..."):
                 else:
                     full_answer = f"请求失败（状态码 {response.status_code}）"
 
-            # 保存AI回复到数据库（使用新连接）
-            conn = sqlite3.connect('users.db')
-            c = conn.cursor()
-            c.execute("INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
-                      (new_conv_id, "assistant", full_answer))
-            conn.commit()
+            # 保存AI回复到数据库
+            db.add_message(new_conv_id, "assistant", full_answer)
 
             # 更新会话历史
             st.session_state.history.append({"role": "assistant", "content": full_answer})
 
         except Exception as e:
-            conn.rollback()
             st.error(f"操作失败: {str(e)}")
-        finally:
-            if conn:
-                conn.close()
 
     else:
 
         # 保存用户消息到数据库
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute("INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
-                  (st.session_state.current_conv, "user", prompt))
-        conn.commit()
+        db.add_message(st.session_state.current_conv, "user", prompt)
 
         # 添加用户问题到历史记录
         st.session_state.history.append({"role": "user", "content": prompt})
@@ -615,7 +528,9 @@ if prompt := st.chat_input("请输入您的问题..."):
             "knowledge_base_name": "math",
             "top_k": 3,
             "score_threshold": 0.85,
-            "history": st.session_state.history[:-1],  # 不包含当前问题
+            # 不包含当前问题；较早的轮次折叠为按对话缓存的摘要，控制在 token 预算内
+            "history": context_builder.builder.build(("conversation", st.session_state.current_conv),
+                                                     st.session_state.history[:-1]),
             "stream": True,  # 必须设置为True
             "model_name": "chatglm3-6b",
             "temperature": 0.3,
@@ -630,7 +545,7 @@ if prompt := st.chat_input("请输入您的问题..."):
         try:
             # 发送流式请求
             with requests.post(
-                    "http://127.0.0.1:7861/chat/knowledge_base_chat",
+                    "http://127.0.0.1:6006/chat/knowledge_base_chat",
                     json=payload,
                     stream=True
             ) as response:
@@ -668,11 +583,7 @@ if prompt := st.chat_input("请输入您的问题..."):
             st.markdown(full_answer)
 
             # 保存助手回复到数据库
-            c.execute("INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
-                    (st.session_state.current_conv, "assistant", full_answer))
-            conn.commit()
-            conn.close()
+            db.add_message(st.session_state.current_conv, "assistant", full_answer)
 
-            # 更新会话历史
-            st.session_state.history.append({"role": "user", "content": prompt})
+            # 更新会话历史（用户问题已在发送前加入）
             st.session_state.history.append({"role": "assistant", "content": full_answer})
\ No newline at end of file
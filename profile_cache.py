@@ -0,0 +1,72 @@
+import os
+import threading
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
+import db
+
+# 侧边栏用到的用户资料、对话列表和群聊列表很少变化，页面每次重跑都查库没有必要：
+# 同一 Streamlit 进程内的所有会话共享带过期时间的缓存，相关写操作后显式失效
+PROFILE_CACHE_TTL = float(os.environ.get("PROFILE_CACHE_TTL", "300"))
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", "4096"))
+CONVERSATION_PAGES_PER_USER = 64
+
+_users = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+_conversations = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+_user_groups = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+_groups = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+_lock = threading.RLock()
+
+
+@cached(_users, lock=_lock)
+def get_user(username):
+    return db.get_user(username)
+
+
+# 对话列表按用户缓存：user_id -> {(游标, 每页条数, 标题搜索): 一页结果}，新建或删除对话时整个用户一起失效
+def list_conversations_page(user_id, cursor=None, limit=20, title_query=None):
+    key = (cursor, limit, title_query)
+    with _lock:
+        pages = _conversations.get(user_id)
+        if pages is not None and key in pages:
+            return pages[key]
+    page = db.list_conversations_page(user_id, cursor, limit, title_query)
+    with _lock:
+        pages = _conversations.get(user_id)
+        if pages is None:
+            pages = _conversations[user_id] = {}
+        # 搜索词组合很多，单个用户缓存的页数有上限
+        if len(pages) >= CONVERSATION_PAGES_PER_USER:
+            pages.clear()
+        pages[key] = page
+    return page
+
+
+@cached(_user_groups, lock=_lock)
+def list_user_group_chats(user_id):
+    return db.list_user_group_chats(user_id)
+
+
+@cached(_groups, lock=_lock)
+def get_group_chat(group_id):
+    return db.get_group_chat(group_id)
+
+
+def _invalidate(cache, *args):
+    with _lock:
+        cache.pop(hashkey(*args), None)
+
+
+# 注册或修改资料后调用
+def invalidate_user(username):
+    _invalidate(_users, username)
+
+
+# 新建或删除对话后调用
+def invalidate_conversations(user_id):
+    with _lock:
+        _conversations.pop(user_id, None)
+
+
+# 创建或加入群聊后调用
+def invalidate_user_groups(user_id):
+    _invalidate(_user_groups, user_id)
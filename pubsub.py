@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+import json
+import os
+import struct
+import tempfile
+from abc import ABC, abstractmethod
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，只能使用单进程的 local 后端
+    fcntl = None
+
+# 群聊广播的发布/订阅后端，使 server.py 可以用 --workers N 多进程运行：
+#   local  单进程，发布即本地投递（不支持 fcntl 的系统上的默认值）
+#   unix   同机多进程，通过 Unix 域套接字代理转发给其他 worker（默认；单进程时自己担任代理）
+# 默认使用 unix，直接 uvicorn server:app --workers N 启动时各 worker 之间的群聊也能互通
+# 以后接入外部消息代理（如 Redis）时实现同样的 start/publish/stop 接口即可
+PUBSUB_BACKEND = os.environ.get("PUBSUB_BACKEND", "unix" if fcntl is not None else "local")
+# 默认套接字按数据库路径区分：使用同一个 users.db 的 worker 互通，同机的其他部署互不干扰
+_DB_KEY = hashlib.sha1(os.path.abspath(os.environ.get("USERS_DB", "users.db")).encode("utf-8")).hexdigest()[:12]
+PUBSUB_SOCKET = os.environ.get("PUBSUB_SOCKET",
+                               os.path.join(tempfile.gettempdir(), f"math_llm_pubsub.{_DB_KEY}.sock"))
+# 代理向单个 worker 积压的字节数超过该值时断开它，由它自行重连
+BROKER_MAX_BUFFER = 8 * 1024 * 1024
+RECONNECT_DELAY = 0.5
+
+# 帧格式：!HI 头（群聊ID长度、消息长度）+ 群聊ID + 消息，均为UTF-8
+_HEADER = struct.Struct("!HI")
+
+
+def encode_frame(group_id, message):
+    group = group_id.encode("utf-8")
+    body = message.encode("utf-8")
+    return _HEADER.pack(len(group), len(body)) + group + body
+
+
+async def read_frame(reader):
+    group_len, body_len = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    payload = await reader.readexactly(group_len + body_len)
+    return payload[:group_len].decode("utf-8"), payload[group_len:].decode("utf-8")
+
+
+# 后端漏实现 publish 时在创建时就报错，而不是等到第一次广播
+class PubSubBackend(ABC):
+    # deliver(group_id, message) 把消息投递给本进程内该群聊的连接
+    async def start(self, deliver):
+        self.deliver = deliver
+
+    # 发布一条群聊消息，消息只在这里序列化一次
+    @abstractmethod
+    async def publish(self, group_id, message):
+        ...
+
+    async def stop(self):
+        pass
+
+
+class LocalPubSub(PubSubBackend):
+    async def publish(self, group_id, message):
+        if not isinstance(message, str):
+            message = json.dumps(message, ensure_ascii=False)
+        self.deliver(group_id, message)
+
+
+# 同机多 worker：持有文件锁的 worker 在自己的事件循环里运行代理，所有 worker（含自己）作为客户端连接
+# 发布时先投递本地连接，再经代理转发给其他 worker；代理所在 worker 退出后，其余 worker 竞争接任
+class UnixSocketPubSub(PubSubBackend):
+    def __init__(self, path=PUBSUB_SOCKET):
+        if fcntl is None:
+            raise RuntimeError("unix 发布/订阅后端需要支持 fcntl 的系统")
+        self.path = path
+        self._lock_file = None
+        self._server = None
+        self._peers = set()
+        self._writer = None
+        self._task = None
+
+    async def start(self, deliver):
+        await super().start(deliver)
+        self._task = asyncio.create_task(self._run())
+
+    async def publish(self, group_id, message):
+        if not isinstance(message, str):
+            message = json.dumps(message, ensure_ascii=False)
+        self.deliver(group_id, message)
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(encode_frame(group_id, message))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._writer is not None:
+            self._writer.close()
+        if self._server is not None:
+            self._server.close()
+            for peer in list(self._peers):
+                peer.close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        if self._lock_file is not None:
+            self._lock_file.close()
+
+    # 非阻塞地尝试获取代理锁，成功则在本进程启动代理
+    async def _try_become_broker(self):
+        if self._server is not None:
+            return
+        lock_file = open(self.path + ".lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return
+        self._lock_file = lock_file
+        # 持有锁说明之前的代理已经退出，残留的套接字文件可以删除
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve_peer, path=self.path)
+
+    async def _serve_peer(self, reader, writer):
+        self._peers.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(_HEADER.size)
+                group_len, body_len = _HEADER.unpack(header)
+                frame = header + await reader.readexactly(group_len + body_len)
+                for peer in list(self._peers):
+                    if peer is writer:
+                        continue
+                    if peer.transport.get_write_buffer_size() > BROKER_MAX_BUFFER:
+                        peer.close()
+                        self._peers.discard(peer)
+                    else:
+                        peer.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # 进程退出时连接任务被取消，直接结束即可
+            pass
+        finally:
+            self._peers.discard(writer)
+            writer.close()
+
+    async def _run(self):
+        while True:
+            try:
+                await self._try_become_broker()
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+                while True:
+                    group_id, message = await read_frame(reader)
+                    self.deliver(group_id, message)
+            except asyncio.CancelledError:
+                raise
+            except (OSError, asyncio.IncompleteReadError):
+                self._writer = None
+                await asyncio.sleep(RECONNECT_DELAY)
+
+
+def create_backend(name=PUBSUB_BACKEND):
+    if name == "local":
+        return LocalPubSub()
+    if name == "unix":
+        return UnixSocketPubSub()
+    raise ValueError(f"未知的发布/订阅后端: {name}")
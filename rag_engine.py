@@ -0,0 +1,205 @@
+import os
+import zlib
+import numpy as np
+import vector_index
+from sparse_index import SparseIndex
+
+# 知识库根目录，结构为 knowledge_base/<知识库名>/content/ 与 vector_store/
+KB_ROOT = os.environ.get("KB_ROOT", "knowledge_base")
+# 向量索引的存储精度，float16 占用一半的磁盘和页缓存
+INDEX_DTYPE = os.environ.get("KB_INDEX_DTYPE", "float32")
+
+# 本地哈希嵌入的维度
+EMBED_DIM = 1024
+
+
+# 文本切分为嵌入用的特征：单字 + 相邻二元组
+def _embed_features(text):
+    chars = [ch for ch in text.lower() if not ch.isspace()]
+    return chars + [a + b for a, b in zip(chars, chars[1:])]
+
+
+# 确定性的本地嵌入函数：特征哈希到固定维度后做L2归一化，离线可用且跨进程结果一致
+def embed_texts(texts):
+    matrix = np.zeros((len(texts), EMBED_DIM), dtype=np.float32)
+    for row, text in enumerate(texts):
+        hashes = np.fromiter((zlib.crc32(f.encode("utf-8")) for f in _embed_features(text)),
+                             dtype=np.uint32)
+        if hashes.size == 0:
+            continue
+        # 低位决定维度，最高位决定符号，降低哈希冲突带来的偏差
+        signs = np.where(hashes >> 31, -1.0, 1.0)
+        counts = np.bincount(hashes % EMBED_DIM, weights=signs, minlength=EMBED_DIM)
+        # 次线性词频，避免长文档中的高频字淹没关键词
+        matrix[row] = np.sign(counts) * np.log1p(np.abs(counts))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+def embed_query(text):
+    return embed_texts([text])[0]
+
+
+def kb_content_dir(kb_name):
+    return os.path.join(KB_ROOT, kb_name, "content")
+
+
+def kb_store_dir(kb_name):
+    return os.path.join(KB_ROOT, kb_name, "vector_store")
+
+
+# 块大小（行），float16索引按块转换为float32打分，避免一次复制整个矩阵
+SCORE_BLOCK_ROWS = 65536
+# 混合检索时两路各取的候选数：max(top_k*FUSION_DEPTH_FACTOR, FUSION_MIN_DEPTH)
+FUSION_DEPTH_FACTOR = 4
+FUSION_MIN_DEPTH = 20
+RRF_K = 60
+
+
+class KnowledgeBase:
+    def __init__(self, name, docs, embeddings, version=0, sparse=None, contents=None):
+        self.name = name
+        # 增量入库删除的分块在docs中为None，对应的行不参与排序
+        self.docs = docs
+        # 分块原文（通常是内存映射的 vector_index.Contents），只在组装检索结果时按行读取
+        self.contents = contents if contents is not None else [doc["content"] if doc else None for doc in docs]
+        self.version = version
+        # 所有文档向量保存在一个连续矩阵中（通常是只读内存映射），一次矩阵乘法完成全部打分
+        self.embeddings = embeddings
+        # BM25倒排索引，与向量索引按行对应
+        self.sparse = sparse
+        live = np.fromiter((doc is not None for doc in docs), dtype=bool, count=len(docs))
+        self.dead_rows = None if live.all() else ~live
+
+    def __len__(self):
+        return len(self.docs)
+
+    def _scores(self, query_matrix):
+        if self.embeddings.dtype == np.float32:
+            return query_matrix @ self.embeddings.T
+        scores = np.empty((query_matrix.shape[0], len(self.docs)), dtype=np.float32)
+        for start in range(0, len(self.docs), SCORE_BLOCK_ROWS):
+            block = np.asarray(self.embeddings[start:start + SCORE_BLOCK_ROWS], dtype=np.float32)
+            scores[:, start:start + len(block)] = query_matrix @ block.T
+        return scores
+
+    # 批量检索：query_matrix 形状为 (查询数, 维度)，返回每个查询的 [(文档下标, 相似度), ...]
+    # score_threshold 沿用 Langchain-Chatchat 的语义：距离(1-余弦相似度)不超过阈值的文档才保留，取1相当于不筛选
+    # top_k 与 score_threshold 可以是单个值，也可以按查询逐个给出；
+    # 传入 texts 且存在倒排索引时做混合检索：向量结果与BM25结果按倒数排名融合，精确匹配的公式和术语不受阈值限制
+    def search(self, query_matrix, top_k, score_threshold=1.0, texts=None):
+        n = len(self.docs)
+        query_matrix = np.atleast_2d(np.asarray(query_matrix, dtype=np.float32))
+        rows = query_matrix.shape[0]
+        # 参数来自客户端：负的 top_k 按0处理，阈值限制在 [0, 1]，批内各查询互不影响
+        top_ks = np.maximum(np.broadcast_to(np.asarray(top_k, dtype=np.int64), rows), 0)
+        min_scores = 1.0 - np.clip(np.broadcast_to(np.asarray(score_threshold, dtype=np.float32), rows), 0.0, 1.0)
+        max_k = int(top_ks.max())
+        if n == 0 or max_k <= 0:
+            return [[] for _ in range(rows)]
+        hybrid = texts is not None and self.sparse is not None
+        scores = self._scores(query_matrix)
+        if self.dead_rows is not None:
+            scores[:, self.dead_rows] = -np.inf
+        k = min(max(max_k * FUSION_DEPTH_FACTOR, FUSION_MIN_DEPTH) if hybrid else max_k, n)
+        if k < n:
+            top_idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top_idx = np.broadcast_to(np.arange(n), scores.shape)
+        top_scores = np.take_along_axis(scores, top_idx, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top_idx = np.take_along_axis(top_idx, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        results = []
+        for row in range(rows):
+            dense = [int(i) for i, s in zip(top_idx[row], top_scores[row])
+                     if s >= min_scores[row] and s > -np.inf]
+            if hybrid:
+                sparse = [i for i, _ in self.sparse.search(texts[row], k)]
+                ranked = reciprocal_rank_fusion([dense, sparse])
+            else:
+                ranked = dense
+            results.append([(i, float(scores[row, i])) for i in ranked[:top_ks[row]]])
+        return results
+
+
+# 倒数排名融合：每个列表中排第 r 位的文档得分 1/(RRF_K+r)，累加后排序
+def reciprocal_rank_fusion(rankings):
+    fused = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, 1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (RRF_K + rank)
+    return sorted(fused, key=fused.get, reverse=True)
+
+
+# 把完整回答切成小块，模拟逐token输出（缓存命中时同样按块流式返回）
+def chunk_text(text, size=8):
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+
+# 不依赖模型服务的占位LLM：基于检索到的知识片段组织回答，并按小块流式输出
+class LocalLLM:
+    def __init__(self, chunk_size=8):
+        self.chunk_size = chunk_size
+
+    def compose(self, query, docs, history=None):
+        if not docs:
+            return f"知识库中没有找到与「{query}」相关的内容，请换一种问法或补充更多细节。"
+        parts = [f"关于「{query}」，知识库中的相关内容如下：\n"]
+        for i, doc in enumerate(docs, 1):
+            parts.append(f"\n{i}. {doc['content']}\n（出处：{'、'.join(doc['sources'])}）\n")
+        return "".join(parts)
+
+    def stream(self, query, docs, history=None):
+        yield from chunk_text(self.compose(query, docs, history), self.chunk_size)
+
+
+# 知识库名 -> (索引元数据修改时间, KnowledgeBase)
+_knowledge_bases = {}
+
+
+def get_knowledge_base(name):
+    store = kb_store_dir(name)
+    mtime = vector_index.meta_mtime(store)
+    cached = _knowledge_bases.get(name)
+    if cached and mtime is not None and cached[0] == mtime:
+        return cached[1]
+
+    # 索引由 ingest.py 构建和更新，这里只映射磁盘文件
+    meta, matrix, contents = vector_index.open_index(store)
+    if meta is None or meta["dim"] != EMBED_DIM:
+        return None
+    # 倒排索引由入库时一并写出；旧版本索引没有倒排文件时在内存中构建
+    sparse = SparseIndex.load(store, meta["version"]) or SparseIndex.build(
+        [contents[i] if doc else None for i, doc in enumerate(meta["docs"])])
+    kb = KnowledgeBase(name, meta["docs"], matrix, version=meta["version"], sparse=sparse, contents=contents)
+    _knowledge_bases[name] = (mtime, kb)
+    return kb
+
+
+class RAGEngine:
+    def __init__(self, llm=None):
+        self.llm = llm or LocalLLM()
+
+    def retrieve(self, kb, query, top_k=3, score_threshold=1.0, query_vector=None):
+        if query_vector is None:
+            query_vector = embed_query(query)
+        return self.hits_to_docs(kb, kb.search(query_vector, top_k, score_threshold, [query])[0])
+
+    def hits_to_docs(self, kb, hits):
+        return [dict(kb.docs[i], content=kb.contents[i], score=score) for i, score in hits]
+
+    def generate(self, query, docs, history=None):
+        return self.llm.stream(query, docs, history)
+
+    # 返回 (检索到的文档, 回答片段生成器)
+    def answer(self, kb, query, top_k=3, score_threshold=1.0, history=None, query_vector=None):
+        docs = self.retrieve(kb, query, top_k, score_threshold, query_vector)
+        return docs, self.generate(query, docs, history)
+
+
+engine = RAGEngine()
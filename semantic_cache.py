@@ -0,0 +1,112 @@
+import os
+import time
+from collections import OrderedDict
+import numpy as np
+from sparse_index import tokenize
+
+# 语义答案缓存的默认配置，可通过环境变量调整
+CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_SIZE", "2048"))
+CACHE_TTL = float(os.environ.get("SEMANTIC_CACHE_TTL", "86400"))
+CACHE_SIMILARITY = float(os.environ.get("SEMANTIC_CACHE_SIMILARITY", "0.92"))
+
+
+# 查询中的数字、LaTeX命令和数学符号（按出现顺序）。嵌入只反映字符与字符二元组，
+# 只差一个数字的两道题（x=1 与 x=2 处的导数、不同的积分上限、不同的矩阵）相似度也会超过阈值，
+# 因此这些记号必须完全相同才可能命中
+def math_signature(text):
+    # 汉字、英文单词以外的词都是数学记号（LaTeX命令以反斜杠开头）
+    return tuple(token for token in tokenize(text) if not token[0].isalpha())
+
+
+# 以查询向量为键的答案缓存：所有缓存向量放在一个预分配矩阵里，一次矩阵向量乘法找出最相似的问题
+# 每条缓存绑定知识库名、索引版本和检索参数，知识库版本变化时整库失效
+class SemanticCache:
+    def __init__(self, dim, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL, similarity=CACHE_SIMILARITY):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.vectors = np.zeros((max_entries, dim), dtype=np.float32)
+        # 每个槽位所属的分区编号，-1表示空槽，查找时只比较同一分区的槽位
+        self.slot_partition = np.full(max_entries, -1, dtype=np.int64)
+        # 槽位 -> (写入时间, 缓存内容)，按最近使用顺序排列
+        self.entries = OrderedDict()
+        self.free_slots = list(range(max_entries - 1, -1, -1))
+        # 分区键 -> 分区编号，分区编号 -> [分区键, 槽位数]；分区清空时删除，客户端参数再多也不会无限增长
+        self.partitions = {}
+        self.partition_info = {}
+        self._next_partition = 0
+        self.kb_versions = {}
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    # 查找时不创建分区，返回None表示该分区没有缓存
+    def _partition(self, kb_name, params, create=False):
+        key = (kb_name,) + tuple(params)
+        partition = self.partitions.get(key)
+        if partition is None and create:
+            partition = self._next_partition
+            self._next_partition += 1
+            self.partitions[key] = partition
+            self.partition_info[partition] = [key, 0]
+        return partition
+
+    def _remove(self, slot):
+        del self.entries[slot]
+        partition = int(self.slot_partition[slot])
+        self.slot_partition[slot] = -1
+        self.free_slots.append(slot)
+        info = self.partition_info[partition]
+        info[1] -= 1
+        if info[1] == 0:
+            del self.partitions[info[0]]
+            del self.partition_info[partition]
+
+    # 知识库索引版本变化时清除该知识库下的全部缓存
+    def _check_version(self, kb_name, version):
+        if self.kb_versions.get(kb_name, version) != version:
+            stale = [slot for slot, (_, entry) in self.entries.items() if entry["kb_name"] == kb_name]
+            for slot in stale:
+                self._remove(slot)
+            self.stats["invalidations"] += len(stale)
+        self.kb_versions[kb_name] = version
+
+    def get(self, kb_name, version, params, query_vector):
+        self._check_version(kb_name, version)
+        partition = self._partition(kb_name, params)
+        candidates = np.flatnonzero(self.slot_partition == partition) if partition is not None else ()
+        if len(candidates):
+            scores = self.vectors[candidates] @ query_vector
+            best = int(np.argmax(scores))
+            slot = int(candidates[best])
+            created, entry = self.entries[slot]
+            if time.monotonic() - created > self.ttl:
+                self._remove(slot)
+                self.stats["expirations"] += 1
+            elif scores[best] >= self.similarity:
+                self.entries.move_to_end(slot)
+                self.stats["hits"] += 1
+                return entry
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, kb_name, version, params, query_vector, answer, docs):
+        if self.max_entries <= 0:
+            return
+        self._check_version(kb_name, version)
+        if not self.free_slots:
+            # 达到容量上限，淘汰最久未使用的一条
+            self._remove(next(iter(self.entries)))
+            self.stats["evictions"] += 1
+        slot = self.free_slots.pop()
+        partition = self._partition(kb_name, params, create=True)
+        self.partition_info[partition][1] += 1
+        self.vectors[slot] = query_vector
+        self.slot_partition[slot] = partition
+        self.entries[slot] = (time.monotonic(), {"kb_name": kb_name, "answer": answer, "docs": docs})
+
+    def info(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return dict(self.stats,
+                    size=len(self.entries),
+                    partitions=len(self.partitions),
+                    max_entries=self.max_entries,
+                    hit_rate=self.stats["hits"] / lookups if lookups else 0.0)
@@ -1,11 +1,83 @@
-from fastapi import FastAPI, WebSocket
+from fastapi import FastAPI, Header, WebSocket, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 import uvicorn
 import json
 import asyncio
+import multiprocessing
+import os
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+from rag_engine import EMBED_DIM, chunk_text, engine, get_knowledge_base
+from ingest import ensure_index
+from embed_batcher import QueryBatcher
+from semantic_cache import SemanticCache, math_signature
+from message_writer import GroupMessageWriter
+import pubsub
+from group_bot import STREAM_FRAME_PREFIX, GroupBot, mentions_bot
+import db
+import context_builder
+import auth
+import avatars
+from archive import Archiver
+from config import BOT_USER_ID
 
-app = FastAPI()
+# 群聊消息确认时机："commit" 提交到数据库后确认，"enqueue" 进入写队列即确认
+MESSAGE_DURABILITY = os.environ.get("GROUP_MESSAGE_DURABILITY", "commit")
+# 以下服务对象都在 lifespan 中创建：python server.py 启动时，密码哈希子进程会以 __mp_main__ 重新执行本模块，
+# 放在模块级别会让每个子进程各分配一份语义缓存等对象
+# 并发查询的嵌入与检索微批处理
+query_batcher = None
+# 群聊消息的后台批量写入
+message_writer = None
+# 群聊广播的跨进程发布/订阅后端
+broadcaster = None
+# 群聊 @数学帮帮 的后台回答队列
+group_bot = None
+# 不活跃对话的周期性冷数据归档
+archiver = None
+# 重复问题的语义答案缓存
+answer_cache = None
+# 密码哈希的进程池
+auth_pool = None
+# 持有后台任务的引用，避免任务在完成前被回收
+background_tasks = set()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global query_batcher, message_writer, broadcaster, group_bot, archiver, answer_cache, auth_pool
+    query_batcher = QueryBatcher()
+    message_writer = GroupMessageWriter()
+    broadcaster = pubsub.create_backend()
+    group_bot = GroupBot(broadcaster.publish, query_batcher, message_writer)
+    archiver = Archiver()
+    answer_cache = SemanticCache(EMBED_DIM)
+    # spawn 启动的子进程不继承本进程的线程和连接；uvicorn server:app 启动时子进程只导入 auth 模块，
+    # python server.py 启动时还会以 __mp_main__ 导入本模块，但不会执行 lifespan
+    auth_pool = ProcessPoolExecutor(auth.AUTH_HASH_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    # 首次启动时构建数学知识库索引，之后只需映射磁盘文件，首个请求无需等待加载
+    ensure_index("math")
+    get_knowledge_base("math")
+    query_batcher.start()
+    message_writer.start()
+    await broadcaster.start(lambda group_id, message: manager.broadcast(message, group_id))
+    group_bot.start()
+    archiver.start()
+    yield
+    await archiver.stop()
+    await group_bot.stop()
+    await broadcaster.stop()
+    await query_batcher.stop()
+    await asyncio.to_thread(message_writer.stop)
+    auth_pool.shutdown(cancel_futures=True)
+
+
+app = FastAPI(lifespan=lifespan)
 
 # 允许跨域
 app.add_middleware(
@@ -17,60 +89,410 @@ app.add_middleware(
 )
 
 
+# 每个连接的发送队列长度；队列写满说明客户端接收过慢
+SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", "256"))
+# 慢客户端处理策略："evict" 断开连接，"drop" 丢弃该连接最旧的待发消息
+SLOW_CONSUMER_POLICY = os.environ.get("WS_SLOW_CONSUMER_POLICY", "evict")
+# 每个群聊在内存中保留的最近消息数，用于断线重连补发；内存补发和数据库补发合计不超过发送队列长度
+REPLAY_BUFFER_SIZE = int(os.environ.get("WS_REPLAY_BUFFER_SIZE", str(SEND_QUEUE_SIZE // 2)))
+
+
+# 单个WebSocket连接：有界发送队列 + 独立的发送任务，慢连接不会拖慢同群其他人
+class ClientConnection:
+    def __init__(self, websocket: WebSocket, group_id: str):
+        self.websocket = websocket
+        self.group_id = group_id
+        self.queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.sender = None
+        self.dropped = 0
+
+    # 非阻塞入队，返回False表示队列已满且策略为断开
+    def send(self, text: str) -> bool:
+        try:
+            self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            if SLOW_CONSUMER_POLICY != "drop":
+                return False
+            self.queue.get_nowait()
+            self.queue.put_nowait(text)
+            self.dropped += 1
+        return True
+
+
+# 数据库中的群聊消息转换为与实时广播相同格式的帧
+def stored_frame(row):
+    return {
+        "type": "message",
+        "msg_id": row.msg_id,
+        "user_id": row.user_id,
+        "username": row.user_id,
+        "content": row.content,
+        "group_id": str(row.group_id),
+        "timestamp": row.timestamp,
+    }
+
+
 # WebSocket连接管理器
 class ConnectionManager:
     def __init__(self):
+        # 群聊ID -> 连接集合，断开时O(1)移除
         self.active_connections = {}
+        # 群聊ID -> 最近广播的消息（环形缓冲）
+        self.recent = {}
+        self._closing = set()
 
-    async def connect(self, websocket: WebSocket, group_id: str):
+    # last_msg_id 为重连客户端最后收到的消息，stored 为内存缓冲中找不到它时预先从数据库读出的后续消息
+    async def connect(self, websocket: WebSocket, group_id: str,
+                      last_msg_id=None, stored=None) -> ClientConnection:
         await websocket.accept()
-        if group_id not in self.active_connections:
-            self.active_connections[group_id] = []
-        self.active_connections[group_id].append(websocket)
+        connection = ClientConnection(websocket, group_id)
+        # 补发和加入群聊之间没有 await，补发内容与之后的实时广播既不重叠也不遗漏
+        if last_msg_id:
+            for text in self.replay(group_id, last_msg_id, stored):
+                connection.send(text)
+        connection.sender = asyncio.create_task(self._send_loop(connection))
+        self.active_connections.setdefault(group_id, set()).add(connection)
+        return connection
+
+    # 内存缓冲中 last_msg_id 之后的消息；缓冲中没有它（断线太久）时返回 None
+    def recent_since(self, group_id: str, last_msg_id: str):
+        recent = list(self.recent.get(group_id, ()))
+        for i in range(len(recent) - 1, -1, -1):
+            if json.loads(recent[i]).get("msg_id") == last_msg_id:
+                return recent[i + 1:]
+        return None
+
+    # 最近的群聊消息，作为机器人回答的对话历史
+    def recent_history(self, group_id: str, limit: int):
+        history = []
+        for text in list(self.recent.get(group_id, ()))[-limit:]:
+            frame = json.loads(text)
+            user_id = frame.get("user_id") or frame.get("username")
+            history.append({"role": "assistant" if user_id == BOT_USER_ID else "user",
+                            "content": f"{user_id}: {frame.get('content', '')}"})
+        return history
 
-    def disconnect(self, websocket: WebSocket, group_id: str):
-        if group_id in self.active_connections:
-            self.active_connections[group_id].remove(websocket)
+    def replay(self, group_id: str, last_msg_id: str, stored=None):
+        recent = self.recent_since(group_id, last_msg_id)
+        if recent is not None:
+            return recent
+        # 先补数据库中的消息，再补内存中尚未写入数据库的消息
+        stored = stored or []
+        seen = {row.msg_id for row in stored}
+        frames = [json.dumps(stored_frame(row), ensure_ascii=False) for row in stored]
+        frames.extend(text for text in self.recent.get(group_id, ())
+                      if json.loads(text).get("msg_id") not in seen)
+        return frames
 
-    async def broadcast(self, message: str, group_id: str):
-        if group_id in self.active_connections:
-            for connection in self.active_connections[group_id]:
-                await connection.send_text(message)
+    def disconnect(self, connection: ClientConnection):
+        group = self.active_connections.get(connection.group_id)
+        if group is not None:
+            group.discard(connection)
+            if not group:
+                del self.active_connections[connection.group_id]
+        if connection.sender is not None and connection.sender is not asyncio.current_task():
+            connection.sender.cancel()
+
+    async def _send_loop(self, connection: ClientConnection):
+        try:
+            while True:
+                await connection.websocket.send_text(await connection.queue.get())
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # 发送失败说明连接已断开，立即移出群聊，不必等它自己的接收循环报错
+            self.disconnect(connection)
+
+    # 断开慢客户端：关闭连接后它的接收循环会退出
+    def evict(self, connection: ClientConnection):
+        self.disconnect(connection)
+        task = asyncio.create_task(self._close(connection))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def _close(self, connection: ClientConnection):
+        try:
+            await connection.websocket.close(code=1013)
+        except Exception:
+            pass
+
+    # 广播只是向各连接的发送队列入队，不等待任何网络发送；消息只序列化一次
+    def broadcast(self, message, group_id: str):
+        if not isinstance(message, str):
+            message = json.dumps(message, ensure_ascii=False)
+        # 机器人回答的流式片段不补发，避免挤占缓冲
+        if not message.startswith(STREAM_FRAME_PREFIX):
+            if group_id not in self.recent:
+                self.recent[group_id] = deque(maxlen=REPLAY_BUFFER_SIZE)
+            self.recent[group_id].append(message)
+        for connection in list(self.active_connections.get(group_id, ())):
+            if not connection.send(message):
+                self.evict(connection)
 
 
 manager = ConnectionManager()
 
 
+# 向发送者确认消息：ack after commit 模式下等待写线程提交完成
+async def send_ack(connection: ClientConnection, msg_id, committed):
+    status = "ok"
+    if MESSAGE_DURABILITY == "commit":
+        try:
+            await committed
+        except Exception:
+            status = "error"
+    else:
+        # 入队即确认，写入失败由写线程记录
+        committed.add_done_callback(lambda f: f.cancelled() or f.exception())
+    # 与广播走同一个发送队列，保证同一连接上的帧不会并发发送
+    if not connection.send(json.dumps({"type": "ack", "msg_id": msg_id, "status": status})):
+        manager.evict(connection)
+
+
+# 校验客户端发来的聊天帧，格式不对时返回None；不合法的消息既不写入也不广播
+# 发送者不看帧中的 user_id，由连接时校验的令牌决定
+def parse_message(data):
+    try:
+        msg_data = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(msg_data, dict):
+        return None
+    for key in ("content", "msg_id"):
+        if not isinstance(msg_data.get(key), str) or not msg_data[key]:
+            return None
+    return msg_data
+
+
 # WebSocket路由
 @app.websocket("/ws/{group_id}")
 async def websocket_endpoint(websocket: WebSocket, group_id: str):
-    await manager.connect(websocket, group_id)
+    # 握手时凭 token 查询参数确定用户，只有群成员才能连接；校验在接受连接和补发消息之前
+    username = auth.verify_token(websocket.query_params.get("token", ""))
+    if (username is None or not group_id.isdigit()
+            or not await asyncio.to_thread(db.is_group_member, username, int(group_id))):
+        await websocket.close(code=1008)
+        return
+    # 重连的客户端带上最后收到的 msg_id，补发断线期间的消息
+    last_msg_id = websocket.query_params.get("last_msg_id")
+    stored = None
+    if last_msg_id and manager.recent_since(group_id, last_msg_id) is None:
+        # 断线期间的消息已超出内存缓冲，才去数据库读取
+        stored = await asyncio.to_thread(db.list_group_messages_since, group_id, last_msg_id, REPLAY_BUFFER_SIZE)
+    connection = await manager.connect(websocket, group_id, last_msg_id, stored)
     try:
         while True:
             data = await websocket.receive_text()
-            msg_data = json.loads(data)
-            user_id = msg_data.get("user_id")
-            with sqlite3.connect('users.db') as conn:
-                c = conn.cursor()
-                # 修改SQL插入语句，增加msg_id字段
-                c.execute("""INSERT INTO group_messages 
-                          (group_id, user_id, content, msg_id) 
-                          VALUES (?, ?, ?, ?)""",
-                          (group_id,
-                           msg_data["user_id"],
-                           msg_data["content"],
-                           msg_data["msg_id"]))
-                conn.commit()
-            await manager.broadcast(data, group_id)
+            msg_data = parse_message(data)
+            if msg_data is None:
+                # 带 msg_id 的按写入失败确认，页面据此提示；否则只回一条提示
+                msg_id = None
+                try:
+                    msg_id = json.loads(data).get("msg_id")
+                except (ValueError, AttributeError):
+                    pass
+                frame = ({"type": "ack", "msg_id": msg_id, "status": "error"} if isinstance(msg_id, str)
+                         else {"type": "notice", "content": "消息格式错误，未发送"})
+                connection.send(json.dumps(frame, ensure_ascii=False))
+                continue
+            msg_data["user_id"] = msg_data["username"] = username
+            msg_data["group_id"] = group_id
+            # 先入队再广播，持久化由写线程批量完成，不阻塞事件循环
+            committed = message_writer.enqueue(group_id, username, msg_data["content"], msg_data["msg_id"])
+            await broadcaster.publish(group_id, json.dumps(msg_data, ensure_ascii=False))
+            # @数学帮帮 的提问交给后台队列，回答生成期间不阻塞本连接的接收
+            if mentions_bot(msg_data["content"]):
+                history = manager.recent_history(group_id, REPLAY_BUFFER_SIZE)
+                if not group_bot.submit(group_id, msg_data["content"], history):
+                    connection.send(json.dumps({"type": "notice", "content": "数学帮帮正忙，请稍后再问"},
+                                               ensure_ascii=False))
+            ack = asyncio.create_task(send_ack(connection, msg_data["msg_id"], committed))
+            background_tasks.add(ack)
+            ack.add_done_callback(background_tasks.discard)
     except Exception as e:
-        manager.disconnect(websocket, group_id)
+        manager.disconnect(connection)
+
+
+# 登录：密码校验在进程池中执行，不阻塞事件循环；成功后返回签名的会话令牌
+@app.post("/auth/login")
+async def login(credentials: dict):
+    username = credentials.get("username", "")
+    password = credentials.get("password", "")
+    password_hash = await asyncio.to_thread(db.get_password_hash, username)
+    loop = asyncio.get_running_loop()
+    ok, new_hash = await loop.run_in_executor(auth_pool, auth.verify_password, password, password_hash)
+    if not ok:
+        return JSONResponse({"status": "invalid_credentials"}, status_code=401)
+    if new_hash is not None:
+        await asyncio.to_thread(db.update_password_hash, username, new_hash)
+    return {"status": "success", "username": username, "token": auth.issue_token(username)}
+
 
-# 原有知识库接口
+# 注册：返回的 status 与 app.py 中的提示一一对应
+@app.post("/auth/register")
+async def register(form: dict):
+    if not auth.PHONE_RE.match(form.get("phone", "")):
+        return JSONResponse({"status": "invalid_phone"}, status_code=400)
+    if form.get("username") == BOT_USER_ID:
+        return JSONResponse({"status": "username_exists"}, status_code=409)
+    loop = asyncio.get_running_loop()
+    password_hash = await loop.run_in_executor(auth_pool, auth.hash_password, form.get("password", ""))
+    try:
+        await asyncio.to_thread(db.create_user, form["username"], form["nickname"], form["phone"],
+                                password_hash, form["role"], form.get("avatar_path", "default_avatar.png"))
+    except sqlite3.IntegrityError as e:
+        if "users.username" in str(e):
+            status = "username_exists"
+        elif "users.phone" in str(e):
+            status = "phone_exists"
+        else:
+            status = "error"
+        return JSONResponse({"status": status}, status_code=409)
+    return {"status": "success"}
+
+
+# 全文检索每页最多返回的条数
+SEARCH_MAX_LIMIT = 50
+
+
+# 从 Authorization: Bearer <令牌> 请求头中取出登录用户，令牌无效时返回None
+def bearer_user(authorization):
+    return auth.verify_token(authorization.removeprefix("Bearer ").strip())
+
+
+# 全文检索：scope 为 chat（自己的单人对话）或 group（所在的群聊），凭登录令牌确定用户
+@app.get("/search")
+def search(q: str, scope: str = "chat", page: int = 1, limit: int = 20, authorization: str = Header("")):
+    username = bearer_user(authorization)
+    if username is None:
+        return JSONResponse({"status": 401}, status_code=401)
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+    page = max(1, page)
+    search_fn = db.search_group_messages if scope == "group" else db.search_messages
+    # 多取一条用于判断是否还有下一页
+    hits = search_fn(username, q, limit + 1, (page - 1) * limit)
+    return {"hits": [asdict(hit) for hit in hits[:limit]], "page": page, "has_more": len(hits) > limit}
+
+
+# 头像按内容哈希命名，文件内容永不改变：强 ETag 即哈希，浏览器可以长期缓存
+AVATAR_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+@app.get("/avatars/{name}")
+async def avatar(name: str, request: Request):
+    if avatars.avatar_name(name) is None:
+        return JSONResponse({"status": 404}, status_code=404)
+    path = os.path.join(avatars.AVATAR_DIR, name)
+    if not os.path.exists(path):
+        return JSONResponse({"status": 404}, status_code=404)
+    etag = f'"{name[:-len(".webp")]}"'
+    headers = {"ETag": etag, "Cache-Control": AVATAR_CACHE_CONTROL}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type="image/webp", headers=headers)
+
+
+# 增量同步每次最多返回的消息数
+SYNC_MAX_LIMIT = 1000
+
+
+# 群聊消息增量同步：只返回ID大于 after 的消息，客户端以返回的 next_after 作为下一次的游标
+# 凭登录令牌确定用户，只能同步自己所在的群聊
+@app.get("/groups/{group_id}/messages")
+def group_messages(group_id: int, after: int = 0, limit: int = 200, authorization: str = Header("")):
+    username = bearer_user(authorization)
+    if username is None:
+        return JSONResponse({"status": 401}, status_code=401)
+    if not db.is_group_member(username, group_id):
+        return JSONResponse({"status": 403}, status_code=403)
+    limit = max(1, min(limit, SYNC_MAX_LIMIT))
+    # 多取一条用于判断是否还有更多
+    rows = db.list_group_messages_after(group_id, after, limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "messages": [asdict(row) for row in rows],
+        "next_after": rows[-1].id if rows else after,
+        "has_more": has_more,
+    }
+
+
+# SSE事件格式，与页面端 iter_lines() 解析 "data: {...}" 的方式对应
+def sse_event(data):
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# 知识库问答接口
 @app.post("/chat/knowledge_base_chat")
-async def chat_endpoint(query: dict):
-    # 保留原有知识库处理逻辑
-    return {"answer": "示例回答", "status": 200}
+async def chat_endpoint(query: dict, request: Request):
+    kb_name = query.get("knowledge_base_name", "math")
+    kb = get_knowledge_base(kb_name)
+    if kb is None:
+        return JSONResponse({"answer": f"未找到知识库 {kb_name}", "status": 404}, status_code=404)
+
+    text = query.get("query", "")
+    # 与检索时一样限制参数范围，阈值保留两位小数，避免任意取值各占一个缓存分区
+    top_k = max(0, int(query.get("top_k", 3)))
+    score_threshold = round(min(max(float(query.get("score_threshold", 1.0)), 0.0), 1.0), 2)
+    # 缓存分区包含查询中的数学记号：数字或公式不同的题目不会共用答案
+    cache_params = (top_k, score_threshold, math_signature(text))
+    history = query.get("history", [])
+    # 带历史的追问（如“那积分呢”）依赖上下文，答案不能与其他对话共用，既不查缓存也不写缓存
+    use_cache = not history
+    # 批处理器先嵌入再查缓存，命中时不再检索
+    lookup = (lambda vector: answer_cache.get(kb_name, kb.version, cache_params, vector)) if use_cache else None
+    query_vector, hits, cached = await query_batcher.submit(kb, text, top_k, score_threshold, lookup)
+    if cached is not None:
+        docs, chunks = cached["docs"], chunk_text(cached["answer"])
+    else:
+        docs = engine.hits_to_docs(kb, hits)
+        # 客户端传来的历史不可信，按 token 预算裁剪
+        chunks = engine.generate(text, docs, context_builder.fit_recent(history))
+    if not query.get("stream", True):
+        # 与流式路径一样在线程池中驱动生成器，接入真实模型后也不阻塞事件循环
+        answer = await run_in_threadpool(lambda: "".join(chunks))
+        if use_cache and cached is None:
+            answer_cache.put(kb_name, kb.version, cache_params, query_vector, answer, docs)
+        return {"answer": answer, "docs": docs, "status": 200}
+
+    async def event_stream():
+        parts = []
+        try:
+            # 生成在线程池中逐块进行，每产出一块立即推送，降低首字延迟
+            async for chunk in iterate_in_threadpool(chunks):
+                if await request.is_disconnected():
+                    break
+                parts.append(chunk)
+                yield sse_event({"answer": chunk})
+            else:
+                yield sse_event({"docs": docs})
+                # 只缓存完整生成的回答
+                if use_cache and cached is None:
+                    answer_cache.put(kb_name, kb.version, cache_params, query_vector, "".join(parts), docs)
+        finally:
+            # 客户端断开（关闭页面）时不再向生成器取块，并关闭它以终止剩余的生成
+            try:
+                chunks.close()
+            except ValueError:
+                # 生成器仍在线程池中执行当前块，取消后不会再被推进
+                pass
+
+    return StreamingResponse(event_stream(),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# 语义缓存命中/未命中统计
+@app.get("/chat/cache_stats")
+async def cache_stats():
+    return answer_cache.info()
 
 
 if __name__ == "__main__":
-    uvicorn.run(app="server:app", host="0.0.0.0", port=6006, reload=True)
\ No newline at end of file
+    # 多 worker 时群聊广播经 pubsub 的 unix 后端跨进程转发（默认后端）；reload 只支持单进程
+    workers = int(os.environ.get("SERVER_WORKERS", "1"))
+    if workers > 1:
+        uvicorn.run(app="server:app", host="0.0.0.0", port=6006, workers=workers)
+    else:
+        uvicorn.run(app="server:app", host="0.0.0.0", port=6006, reload=True)
\ No newline at end of file
@@ -0,0 +1,126 @@
+import json
+import math
+import os
+import re
+from collections import Counter
+import numpy as np
+
+# 分词规则：LaTeX命令与数学符号整体作为一个词，英文单词和数字各自成词，连续汉字切成二元组
+TOKEN_RE = re.compile(
+    r"\\[a-zA-Z]+"
+    r"|[a-zA-Z]+"
+    r"|\d+(?:\.\d+)?"
+    r"|[一-鿿㐀-䶿]+"
+    r"|[=+\-*/^<>!|′'≤≥≠≈≡∞∑∏∫∮∂∇√±×÷·∈∉⊂⊆∪∩∀∃→⇒⇔]"
+)
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def tokenize(text):
+    tokens = []
+    for match in TOKEN_RE.finditer(text):
+        token = match.group()
+        if "㐀" <= token[0] <= "鿿":
+            if len(token) == 1:
+                tokens.append(token)
+            else:
+                tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+        else:
+            tokens.append(token.lower() if token[0].isalpha() else token)
+    return tokens
+
+
+# BM25倒排索引，倒排表按CSR格式存放在紧凑数组中：
+#   offsets[t]:offsets[t+1] 是词 t 的倒排区间，doc_ids/tfs 为对应的文档行号与词频
+class SparseIndex:
+    def __init__(self, vocab, offsets, doc_ids, tfs, doc_len):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.n_docs = int(np.count_nonzero(doc_len))
+        self.avgdl = float(doc_len.sum()) / self.n_docs if self.n_docs else 1.0
+
+    # texts 为分块原文，与向量索引的行一一对应，已删除的行为None
+    @classmethod
+    def build(cls, texts):
+        postings = {}
+        doc_len = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            if text is None:
+                continue
+            counts = Counter(tokenize(text))
+            doc_len[row] = sum(counts.values())
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((row, tf))
+
+        terms = sorted(postings)
+        vocab = {term: i for i, term in enumerate(terms)}
+        sizes = np.fromiter((len(postings[t]) for t in terms), dtype=np.int64, count=len(terms))
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        doc_ids = np.empty(offsets[-1], dtype=np.int32)
+        tfs = np.empty(offsets[-1], dtype=np.float32)
+        for i, term in enumerate(terms):
+            rows, counts = zip(*postings[term])
+            doc_ids[offsets[i]:offsets[i + 1]] = rows
+            tfs[offsets[i]:offsets[i + 1]] = counts
+        return cls(vocab, offsets, doc_ids, tfs, doc_len)
+
+    def scores(self, text):
+        scores = np.zeros(len(self.doc_len), dtype=np.float32)
+        for term in set(tokenize(text)):
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            lo, hi = self.offsets[term_id], self.offsets[term_id + 1]
+            ids = self.doc_ids[lo:hi]
+            tf = self.tfs[lo:hi]
+            idf = math.log(1 + (self.n_docs - (hi - lo) + 0.5) / ((hi - lo) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_len[ids] / self.avgdl)
+            # 同一个词的倒排表内文档不重复，可以直接按下标累加
+            scores[ids] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores
+
+    # 返回BM25得分最高的 k 个文档 [(行号, 得分), ...]
+    def search(self, text, k):
+        scores = self.scores(text)
+        candidates = np.flatnonzero(scores)
+        if candidates.size > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(int(i), float(scores[i])) for i in candidates]
+
+    # 与向量索引同版本号的文件：sparse.v<版本>.json 存词表，其余数组为 .npy，加载时内存映射
+    def save(self, path, version):
+        prefix = os.path.join(path, f"sparse.v{version}")
+        # 临时文件带上进程号；词表最后写入，加载时以它的存在作为完整性标志
+        for name in ("offsets", "doc_ids", "tfs", "doc_len"):
+            tmp = f"{prefix}.{name}.npy.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, getattr(self, name))
+            os.replace(tmp, f"{prefix}.{name}.npy")
+        tmp = f"{prefix}.json.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.vocab, f, ensure_ascii=False)
+        os.replace(tmp, f"{prefix}.json")
+        for filename in os.listdir(path):
+            if filename.startswith("sparse.v") and not filename.startswith(f"sparse.v{version}."):
+                try:
+                    os.remove(os.path.join(path, filename))
+                except FileNotFoundError:
+                    pass
+
+    @classmethod
+    def load(cls, path, version):
+        prefix = os.path.join(path, f"sparse.v{version}")
+        try:
+            with open(f"{prefix}.json", encoding="utf-8") as f:
+                vocab = json.load(f)
+            arrays = [np.load(f"{prefix}.{name}.npy", mmap_mode="r")
+                      for name in ("offsets", "doc_ids", "tfs", "doc_len")]
+        except FileNotFoundError:
+            return None
+        return cls(vocab, *arrays)
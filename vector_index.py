@@ -0,0 +1,224 @@
+import json
+import os
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，只能由单个进程入库
+    fcntl = None
+
+# 磁盘索引格式（位于 knowledge_base/<知识库名>/vector_store/）：
+#   meta.json                       元数据：版本号、维度、数据类型、行数、文档列表（哈希与出处，已删除的行为null）、源文件清单
+#   embeddings.v<版本>.<dtype>      行优先的原始向量矩阵，通过 np.memmap 只读映射
+#   contents.v<版本>.utf8           分块原文依次拼接的UTF-8字节，与矩阵一样在增量更新时追加
+#   contents.v<版本>.offsets.npy    每行原文在上述文件中的起止偏移（行数+1个），每个元数据版本一份
+# 多个 uvicorn worker 映射同一批文件，共享操作系统页缓存，启动时无需读入原文或重新嵌入
+META_FILE = "meta.json"
+# 入库互斥锁：多个 worker 同时首次启动或与命令行入库并发时，同一时刻只有一个进程写索引
+LOCK_FILE = ".lock"
+DTYPES = {"float32": np.float32, "float16": np.float16}
+
+
+def meta_path(path):
+    return os.path.join(path, META_FILE)
+
+
+# 元数据文件的修改时间，用于判断索引是否被重写；索引不存在时返回None
+def meta_mtime(path):
+    try:
+        return os.stat(meta_path(path)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def read_meta(path):
+    try:
+        with open(meta_path(path), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def index_lock(path):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, LOCK_FILE), "w") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        # 关闭文件即释放锁
+        yield
+
+
+# 临时文件带上进程号，即使绕过锁并发写入也不会互相覆盖或抢走对方的临时文件
+def tmp_name(filename):
+    return f"{filename}.{os.getpid()}.tmp"
+
+
+def contents_name(version):
+    return f"contents.v{version}.utf8"
+
+
+def offsets_name(version):
+    return f"contents.v{version}.offsets.npy"
+
+
+def _remove(path, filename):
+    try:
+        os.remove(os.path.join(path, filename))
+    except FileNotFoundError:
+        pass
+
+
+def _encode_contents(contents):
+    # 已删除的行没有原文，占一个空区间
+    chunks = [(content or "").encode("utf-8") for content in contents]
+    lengths = np.fromiter((len(chunk) for chunk in chunks), dtype=np.int64, count=len(chunks))
+    return b"".join(chunks), lengths
+
+
+def _write_offsets(path, version, offsets):
+    filename = os.path.join(path, offsets_name(version))
+    tmp = tmp_name(filename)
+    with open(tmp, "wb") as f:
+        np.save(f, np.asarray(offsets, dtype=np.int64))
+    os.replace(tmp, filename)
+
+
+def _write_json(filename, data):
+    tmp = tmp_name(filename)
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, filename)
+
+
+# 写入新版本索引：先写矩阵和原文再原子替换元数据，读者要么看到旧版本要么看到新版本
+# contents 为与 docs 逐行对应的分块原文
+def save_index(path, docs, contents, embeddings, dtype="float32", **extra):
+    if dtype not in DTYPES:
+        raise ValueError(f"不支持的索引数据类型: {dtype}")
+    os.makedirs(path, exist_ok=True)
+    old_meta = read_meta(path)
+    version = old_meta["version"] + 1 if old_meta else 1
+
+    matrix = np.ascontiguousarray(embeddings, dtype=DTYPES[dtype])
+    matrix_file = f"embeddings.v{version}.{dtype}"
+    tmp = tmp_name(os.path.join(path, matrix_file))
+    matrix.tofile(tmp)
+    os.replace(tmp, os.path.join(path, matrix_file))
+
+    blob, lengths = _encode_contents(contents)
+    contents_file = contents_name(version)
+    tmp = tmp_name(os.path.join(path, contents_file))
+    with open(tmp, "wb") as f:
+        f.write(blob)
+    os.replace(tmp, os.path.join(path, contents_file))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    _write_offsets(path, version, offsets)
+
+    meta = {
+        "version": version,
+        "dim": int(matrix.shape[1]),
+        "dtype": dtype,
+        "count": int(matrix.shape[0]),
+        "matrix_file": matrix_file,
+        "contents_file": contents_file,
+        "offsets_file": offsets_name(version),
+        "docs": docs,
+        **extra,
+    }
+    _write_json(meta_path(path), meta)
+
+    # 已映射旧文件的进程仍持有inode，删除目录项不影响它们继续读取
+    if old_meta:
+        for key in ("matrix_file", "contents_file", "offsets_file"):
+            if old_meta.get(key) and old_meta[key] != meta[key]:
+                _remove(path, old_meta[key])
+    return meta
+
+
+# 原地增量更新：新向量和新原文追加到文件末尾，删除的行清零并在元数据中标记为null
+# 已映射旧长度的读者不受追加影响，清零的行在旧元数据下也只会得到零分
+def update_index(path, meta, docs, new_contents, new_embeddings, removed_rows=(), **extra):
+    dtype = DTYPES[meta["dtype"]]
+    matrix_path = os.path.join(path, meta["matrix_file"])
+    if len(removed_rows) and meta["count"]:
+        matrix = np.memmap(matrix_path, dtype=dtype, mode="r+", shape=(meta["count"], meta["dim"]))
+        matrix[np.asarray(removed_rows, dtype=np.int64)] = 0
+        matrix.flush()
+        del matrix
+    new_matrix = np.ascontiguousarray(new_embeddings, dtype=dtype).reshape(-1, meta["dim"])
+    # 读者按元数据的行数从文件开头映射：先截掉之前中断的更新追加的多余行，新行紧接在已提交的行之后
+    # 已映射的读者只访问前 count 行，截断不影响它们
+    with open(matrix_path, "r+b") as f:
+        f.truncate(meta["count"] * meta["dim"] * np.dtype(dtype).itemsize)
+        f.seek(0, os.SEEK_END)
+        f.write(new_matrix.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+    # 原文追加在文件当前末尾之后（之前中断的更新可能留下未被引用的尾部字节）
+    blob, lengths = _encode_contents(new_contents)
+    with open(os.path.join(path, meta["contents_file"]), "ab") as f:
+        base = f.tell()
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    old_offsets = np.load(os.path.join(path, meta["offsets_file"]))
+    offsets = np.concatenate([old_offsets, base + np.cumsum(lengths)])
+
+    old_offsets_file = meta["offsets_file"]
+    meta = dict(meta, **extra)
+    version = meta["version"] + 1
+    _write_offsets(path, version, offsets)
+    meta.update(version=version, count=meta["count"] + len(new_matrix), docs=docs,
+                offsets_file=offsets_name(version))
+    _write_json(meta_path(path), meta)
+    _remove(path, old_offsets_file)
+    return meta
+
+
+# 分块原文的只读视图：偏移数组与UTF-8字节都是内存映射，按行切片解码，各进程不再各自持有一份原文
+class Contents:
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        return bytes(self.blob[self.offsets[row]:self.offsets[row + 1]]).decode("utf-8")
+
+
+def _open_contents(path, meta):
+    if "contents_file" not in meta:
+        # 旧格式的索引：原文仍保存在元数据的文档列表中，下次入库时改写为新格式
+        return [doc["content"] if doc else None for doc in meta["docs"]]
+    offsets = np.load(os.path.join(path, meta["offsets_file"]), mmap_mode="r")
+    size = int(offsets[-1])
+    # 空文件无法映射；只映射偏移覆盖的部分，之后追加的字节不可见
+    blob = np.memmap(os.path.join(path, meta["contents_file"]), dtype=np.uint8, mode="r",
+                     shape=(size,)) if size else np.zeros(0, dtype=np.uint8)
+    return Contents(blob, offsets)
+
+
+# 打开索引，返回 (元数据, 只读内存映射矩阵, 分块原文)
+def open_index(path, retries=1):
+    meta = read_meta(path)
+    if meta is None:
+        return None, None, None
+    dtype = DTYPES[meta["dtype"]]
+    shape = (meta["count"], meta["dim"])
+    try:
+        contents = _open_contents(path, meta)
+        if meta["count"] == 0:
+            return meta, np.zeros(shape, dtype=dtype), contents
+        matrix = np.memmap(os.path.join(path, meta["matrix_file"]), dtype=dtype, mode="r", shape=shape)
+    except FileNotFoundError:
+        # 读取元数据后索引恰好被重写，旧文件已删除，重新读取一次
+        if retries <= 0:
+            raise
+        return open_index(path, retries - 1)
+    return meta, matrix, contents